@@ -0,0 +1,205 @@
+"""
+Benchmark of the ways to serve the Wishlist service
+
+Starts the service with each server in turn, fills it with Wishlists and
+runs many concurrent clients against one route for a fixed time, then
+prints the throughput and latency of each server, and on Linux the memory
+of its processes.
+
+Servers:
+    sync     - one gunicorn sync worker without preloading, as in the old Procfile
+    single, threaded, ... - gunicorn.conf.py with that GUNICORN_PROFILE
+
+Run it with:
+    python benchmarks/concurrency.py --concurrency 100 --duration 10
+    python benchmarks/concurrency.py --servers single,sync-profile,threaded
+
+The servers use DATABASE_URI, or a temporary SQLite file when it is not
+set. The cache is turned off so that every request goes to the database.
+Use Postgres for numbers that mean anything, SQLite is a local file and
+has none of the network round trips of a real database.
+"""
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GUNICORN = ["gunicorn", "--config=gunicorn.conf.py", "--bind={host}:{port}", "service:app"]
+SERVERS = {
+    # one worker without preloading, as the old Procfile ran it
+    "sync": (GUNICORN, {"GUNICORN_PROFILE": "single", "GUNICORN_PRELOAD": "false"}),
+    "single": (GUNICORN, {"GUNICORN_PROFILE": "single"}),
+    "sync-profile": (GUNICORN, {"GUNICORN_PROFILE": "sync"}),
+    "threaded": (GUNICORN, {"GUNICORN_PROFILE": "threaded"}),
+}
+
+
+def server_environment():
+    """Returns the environment the servers and the migration run with"""
+    env = dict(os.environ, FLASK_APP="service:app", CACHE_BACKEND="none")
+    if "DATABASE_URI" not in env:
+        env["DATABASE_URI"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    return env
+
+
+def wait_until_up(host, port, process, timeout=30):
+    """Waits for the server to answer, fails if it exits first"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit("The server exited with code {}".format(process.returncode))
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=1)
+            connection.request("GET", "/wishlists?limit=1")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    sys.exit("The server did not start in {} seconds".format(timeout))
+
+
+def seed(host, port, wishlists, products):
+    """Creates Wishlists with Products through the API and returns their ids"""
+    connection = http.client.HTTPConnection(host, port)
+    body = [
+        {"name": "wishlist {}".format(number), "customer_id": number,
+         "products": [{"item_id": item, "name": "product {}".format(item)} for item in range(products)]}
+        for number in range(wishlists)
+    ]
+    connection.request("POST", "/wishlists/batch", json.dumps(body), {"Content-Type": "application/json"})
+    response = connection.getresponse()
+    ids = json.loads(response.read())["ids"]
+    connection.close()
+    return ids
+
+
+def client(host, port, paths, stop, latencies, errors):
+    """Sends requests on one keep-alive connection until stop is set"""
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            connection.request("GET", random.choice(paths))
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as error:
+            errors.append(type(error).__name__)
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+
+
+def memory_kib(pid):
+    """Returns the proportional and private memory of a process in KiB, None off Linux"""
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid)) as smaps:
+            sizes = dict(line.split()[:2] for line in smaps if line.split()[0].endswith(":"))
+    except OSError:
+        return None
+    private = int(sizes.get("Private_Clean:", 0)) + int(sizes.get("Private_Dirty:", 0))
+    return int(sizes.get("Pss:", 0)), private
+
+
+def process_tree(pid):
+    """Returns the pid and the pids of all of the children of a process"""
+    pids = [pid]
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as children:
+            for child in children.read().split():
+                pids.extend(process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+def percentile(values, fraction):
+    """Returns the value below which the given fraction of the values fall"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(name, args, env):
+    """Benchmarks one server and returns its results"""
+    command, server_env = SERVERS[name]
+    command = [part.format(host=args.host, port=args.port) for part in command]
+    process = subprocess.Popen(command, cwd=ROOT, env=dict(env, **server_env),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(args.host, args.port, process)
+        ids = seed(args.host, args.port, args.wishlists, args.products)
+        paths = [args.path.format(id=wishlist_id) for wishlist_id in ids]
+        stop = threading.Event()
+        latencies = []
+        errors = []
+        threads = [
+            threading.Thread(target=client, args=(args.host, args.port, paths, stop, latencies, errors))
+            for _ in range(args.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        # measured after the load, when every worker has served requests
+        memory = [memory_kib(pid) for pid in process_tree(process.pid)]
+    finally:
+        process.terminate()
+        process.wait()
+    if not latencies:
+        sys.exit("No request to the {} server succeeded: {}".format(name, errors[:5]))
+    memory = [sizes for sizes in memory if sizes is not None]
+    return {
+        "server": name,
+        "processes": len(memory),
+        "requests_per_second": len(latencies) / args.duration,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "errors": len(errors),
+        # proportional set size counts shared pages once across the processes
+        "total_pss_mib": sum(pss for pss, _ in memory) / 1024,
+        "max_private_mib": max((private for _, private in memory), default=0) / 1024,
+    }
+
+
+def main():
+    """Runs the benchmark against each server and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", default="sync,single", help="Comma separated servers to run: " + ", ".join(SERVERS))
+    parser.add_argument("--concurrency", type=int, default=100, help="Clients sending requests at the same time")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to send requests for")
+    parser.add_argument("--path", default="/wishlists/{id}", help="Route to request, {id} is a Wishlist id")
+    parser.add_argument("--wishlists", type=int, default=50, help="Wishlists to create")
+    parser.add_argument("--products", type=int, default=10, help="Products in each Wishlist")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+
+    env = server_environment()
+    subprocess.run([sys.executable, "-m", "flask", "db", "upgrade"], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    print("{} clients for {}s on {}".format(args.concurrency, args.duration, args.path))
+    print("{:12} {:>5} {:>8} {:>8} {:>8} {:>6} {:>10} {:>12}".format(
+        "server", "procs", "req/s", "p50 ms", "p99 ms", "errors", "PSS MiB", "private MiB"))
+    for name in args.servers.split(","):
+        result = run(name, args, env)
+        print("{server:12} {processes:5} {requests_per_second:8.1f} {p50_ms:8.1f} {p99_ms:8.1f} {errors:6} "
+              "{total_pss_mib:10.1f} {max_private_mib:12.1f}".format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+The database the in-process benchmarks run on
+
+The benchmarks never use DATABASE_URI, which may point at a development
+or CI database. They run on BENCHMARK_DATABASE_URI, or on a new temporary
+SQLite file when it is not set. The schema is built by the migrations,
+as for the service, so the benchmarks see the real indexes and triggers.
+A database that already has Wishlists or Products is refused instead of
+emptied, and the rows a benchmark adds are deleted when it is done.
+
+Call use_benchmark_database() before the service is imported:
+
+    import database
+    database.use_benchmark_database()
+    from service import app
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+
+def use_benchmark_database():
+    """Points the service at the benchmark database and returns its URI"""
+    uri = os.getenv("BENCHMARK_DATABASE_URI") or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    os.environ["DATABASE_URI"] = uri
+    # a replica would not see the rows the benchmark just wrote
+    os.environ.pop("REPLICA_DATABASE_URI", None)
+    return uri
+
+
+@contextmanager
+def benchmark_tables():
+    """Migrates the benchmark database, exits if it has rows, and deletes the rows added inside"""
+    from service.migrations import upgrade
+    from service.models import db, Wishlist, Product
+    upgrade(db.engine)
+    for model in (Wishlist, Product):
+        if db.session.query(model.query.exists()).scalar():
+            db.session.remove()
+            sys.exit("{} already has rows in {!r}, the benchmarks only run on an empty database".format(
+                model.__tablename__, db.engine.url))
+    try:
+        yield
+    finally:
+        db.session.remove()
+        with db.engine.begin() as connection:
+            connection.execute(Product.__table__.delete())
+            connection.execute(Wishlist.__table__.delete())
@@ -0,0 +1,366 @@
+"""
+Load test of the Wishlist service with a mix of realistic requests
+
+Starts the service with gunicorn.conf.py, fills it with customers that
+have Wishlists with Products, and runs many clients for a fixed time.
+Each client owns some of the customers and walks through the same steps
+as the scenarios in features/pets.feature, picked at random with the
+weights of --mix:
+
+    list       - GET /wishlists?customer_id={customer_id}
+    get        - GET /wishlists/{id}
+    add_item   - POST /wishlists/{id}/items
+    purchase   - PUT /wishlists/{id}/items/{item_id}/purchase of an item still available
+    delete     - POST /wishlists of a replacement ("create"), then DELETE /wishlists/{id}
+
+It prints the throughput, the error rate and the p50, p95 and p99 latency
+of every endpoint and saves them, with the commit they were measured on,
+as JSON in benchmarks/results/ so runs on different commits can be put
+side by side with --compare.
+
+Run it with:
+    python benchmarks/loadtest.py --concurrency 20 --duration 30
+    python benchmarks/loadtest.py --compare benchmarks/results/loadtest-1a2b3c4.json
+    python benchmarks/loadtest.py --url http://127.0.0.1:8080
+
+The service uses DATABASE_URI, or a temporary SQLite file when it is not
+set, and is migrated before it starts. With --url the requests go to a
+service that is already running instead, which must be migrated.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from collections import Counter
+
+from concurrency import ROOT, percentile, server_environment, wait_until_up
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+DEFAULT_MIX = "list=25,get=40,add_item=15,purchase=15,delete=5"
+# status a request of each endpoint answers with when it worked
+EXPECTED = {"list": 200, "get": 200, "add_item": 201, "purchase": 200, "delete": 204, "create": 201}
+# the most Wishlists POST /wishlists/batch takes, the service reads the same variable
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+
+
+def parse_mix(text):
+    """Parses "scenario=weight,..." into a dictionary"""
+    mix = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        name, _, weight = item.partition("=")
+        if name.strip() not in EXPECTED or name.strip() == "create":
+            sys.exit("Unknown scenario '{}'".format(name.strip()))
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def commit():
+    """Returns the short hash of the checked out commit and whether the tree has changes"""
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, check=True,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return revision, bool(changes)
+
+
+def wishlist_body(customer_id, number, products):
+    """Returns the JSON of a new Wishlist with products"""
+    return {
+        "name": "wishlist {} of {}".format(number, customer_id),
+        "customer_id": customer_id,
+        "products": [{"item_id": item, "name": "product {}".format(item)} for item in range(products)],
+    }
+
+
+def seed(host, port, customers, wishlists, products, batch_size=MAX_BATCH_SIZE):
+    """Creates the Wishlists of the customers and returns {customer_id: [wishlist ids]}"""
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    owned = {}
+    wanted = [(customer_id, number) for customer_id in range(1, customers + 1) for number in range(wishlists)]
+    for first in range(0, len(wanted), batch_size):
+        batch = wanted[first:first + batch_size]
+        body = [wishlist_body(customer_id, number, products) for customer_id, number in batch]
+        connection.request("POST", "/wishlists/batch", json.dumps(body), {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        data = json.loads(response.read())
+        if response.status != 201:
+            sys.exit("Could not seed the service: {} {}".format(response.status, data))
+        for (customer_id, _), wishlist_id in zip(batch, data["ids"]):
+            owned.setdefault(customer_id, []).append(wishlist_id)
+    connection.close()
+    return owned
+
+
+class Recorder():
+    """Latencies and statuses of the requests of every endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = Counter()
+
+    def add(self, endpoint, seconds, status):
+        """Records one request, status is the HTTP status or the name of an exception"""
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            self.statuses.setdefault(endpoint, Counter())[str(status)] += 1
+            if status != EXPECTED[endpoint]:
+                self.errors[endpoint] += 1
+
+    def summary(self, duration):
+        """Returns the throughput, error rate and latency percentiles of each endpoint and of all"""
+        def describe(latencies, errors, statuses):
+            return {
+                "requests": len(latencies),
+                "requests_per_second": round(len(latencies) / duration, 1),
+                "errors": errors,
+                "error_rate": round(errors / len(latencies), 4) if latencies else 0,
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+                "statuses": dict(statuses),
+            }
+        endpoints = {
+            endpoint: describe(self.latencies[endpoint], self.errors[endpoint], self.statuses[endpoint])
+            for endpoint in sorted(self.latencies)
+        }
+        everything = [seconds for latencies in self.latencies.values() for seconds in latencies]
+        statuses = sum(self.statuses.values(), Counter())
+        total = describe(everything, sum(self.errors.values()), statuses) if everything else None
+        return endpoints, total
+
+
+class Client():
+    """One user of the service that works on its own customers"""
+
+    def __init__(self, host, port, owned, args, recorder, recording, rng):
+        self.host = host
+        self.port = port
+        self.owned = owned
+        self.args = args
+        self.recorder = recorder
+        self.recording = recording
+        self.rng = rng
+        self.available = {}
+        self.connection = http.client.HTTPConnection(host, port, timeout=30)
+        self.scenarios = list(args.mix)
+        self.weights = [args.mix[name] for name in self.scenarios]
+
+    def request(self, endpoint, method, path, body=None):
+        """Sends a request and records it while the run is being measured, returns (status, data)"""
+        measured = self.recording.is_set()
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        started = time.perf_counter()
+        try:
+            self.connection.request(method, path, None if body is None else json.dumps(body), headers)
+            response = self.connection.getresponse()
+            payload = response.read()
+        except (OSError, http.client.HTTPException) as error:
+            if measured:
+                self.recorder.add(endpoint, time.perf_counter() - started, type(error).__name__)
+            self.connection.close()
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            return None, None
+        if measured:
+            self.recorder.add(endpoint, time.perf_counter() - started, response.status)
+        try:
+            return response.status, json.loads(payload) if payload else None
+        except ValueError:
+            return response.status, None
+
+    def wishlist(self):
+        """Returns one of the customers of this client and one of its Wishlists"""
+        customer_id = self.rng.choice(list(self.owned))
+        return customer_id, self.rng.choice(self.owned[customer_id])
+
+    def items(self, wishlist_id):
+        """Returns the ids of the Products of a Wishlist that are still available"""
+        if wishlist_id not in self.available:
+            status, data = self.request("get", "GET", "/wishlists/{}".format(wishlist_id))
+            products = data.get("products", []) if status == 200 else []
+            self.available[wishlist_id] = [product["id"] for product in products if not product["purchased"]]
+        return self.available[wishlist_id]
+
+    def list(self):
+        """Lists the Wishlists of a customer"""
+        customer_id, _ = self.wishlist()
+        self.request("list", "GET", "/wishlists?" + urllib.parse.urlencode({"customer_id": customer_id}))
+
+    def get(self):
+        """Reads a Wishlist"""
+        _, wishlist_id = self.wishlist()
+        self.request("get", "GET", "/wishlists/{}".format(wishlist_id))
+
+    def add_item(self):
+        """Adds a Product to a Wishlist"""
+        _, wishlist_id = self.wishlist()
+        item_id = self.rng.randrange(1, 1000000)
+        status, data = self.request("add_item", "POST", "/wishlists/{}/items".format(wishlist_id),
+                                    {"item_id": item_id, "name": "product {}".format(item_id), "purchased": False})
+        if status == 201 and wishlist_id in self.available:
+            self.available[wishlist_id].append(data["id"])
+
+    def purchase(self):
+        """Purchases a Product that is still available, or adds one if there is none"""
+        _, wishlist_id = self.wishlist()
+        items = self.items(wishlist_id)
+        if not items:
+            return self.add_item()
+        item_id = items.pop(self.rng.randrange(len(items)))
+        self.request("purchase", "PUT", "/wishlists/{}/items/{}/purchase".format(wishlist_id, item_id))
+
+    def delete(self):
+        """Replaces a Wishlist of a customer with a new one"""
+        customer_id, wishlist_id = self.wishlist()
+        # created first so that the size of the data stays the same and no customer runs out
+        status, data = self.request("create", "POST", "/wishlists",
+                                    wishlist_body(customer_id, self.rng.randrange(1000000), self.args.products))
+        if status == 201:
+            self.owned[customer_id].append(data["id"])
+        status, _ = self.request("delete", "DELETE", "/wishlists/{}".format(wishlist_id))
+        if status == 204:
+            self.owned[customer_id].remove(wishlist_id)
+            self.available.pop(wishlist_id, None)
+
+    def run(self, stop):
+        """Runs random scenarios until stop is set"""
+        while not stop.is_set():
+            getattr(self, self.rng.choices(self.scenarios, self.weights)[0])()
+        self.connection.close()
+
+
+def start_server(args, env):
+    """Migrates the database and starts gunicorn, returns the process"""
+    subprocess.run([sys.executable, "-m", "flask", "db", "upgrade"], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    command = ["gunicorn", "--config=gunicorn.conf.py", "--bind={}:{}".format(args.host, args.port), "service:app"]
+    process = subprocess.Popen(command, cwd=ROOT, env=dict(env, GUNICORN_PROFILE=args.profile),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_until_up(args.host, args.port, process)
+    return process
+
+
+def run(args):
+    """Seeds the service, runs the clients and returns the recorder"""
+    owned = seed(args.host, args.port, args.customers, args.wishlists, args.products, args.batch_size)
+    customers = sorted(owned)
+    recorder = Recorder()
+    recording = threading.Event()
+    stop = threading.Event()
+    clients = [
+        Client(args.host, args.port, {customer_id: owned[customer_id] for customer_id in customers[number::args.concurrency]},
+               args, recorder, recording, random.Random(args.seed + number))
+        for number in range(min(args.concurrency, len(customers)))
+    ]
+    threads = [threading.Thread(target=client.run, args=(stop,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.warmup)
+    recording.set()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return recorder
+
+
+def print_results(endpoints, total, baseline=None):
+    """Prints a line per endpoint, with the change from the baseline results if given"""
+    print("{:10} {:>8} {:>8} {:>7} {:>9} {:>9} {:>9}".format(
+        "endpoint", "requests", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms"))
+    rows = list(endpoints.items()) + [("total", total)]
+    for name, result in rows:
+        print("{:10} {requests:8} {requests_per_second:8.1f} {error_rate:7.2%} {p50_ms:9.2f} {p95_ms:9.2f} "
+              "{p99_ms:9.2f}".format(name, **result))
+        old = (baseline["endpoints"].get(name) if name != "total" else baseline["total"]) if baseline else None
+        if old:
+            def change(key):
+                return "{:+.0%}".format(result[key] / old[key] - 1) if old[key] else "-"
+            print("{:10} {:>8} {:>8} {:>7} {:>9} {:>9} {:>9}".format(
+                "  vs " + baseline["commit"][:5], "", change("requests_per_second"),
+                "{:+.2%}".format(result["error_rate"] - old["error_rate"]),
+                change("p50_ms"), change("p95_ms"), change("p99_ms")))
+
+
+def main():
+    """Runs the load test, prints the results and saves them"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=20, help="Clients sending requests at the same time")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to measure for")
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds to send requests for before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help="Weights of the scenarios, default " + DEFAULT_MIX)
+    parser.add_argument("--customers", type=int, default=200, help="Customers to create")
+    parser.add_argument("--wishlists", type=int, default=3, help="Wishlists of each customer")
+    parser.add_argument("--products", type=int, default=10, help="Products in each Wishlist")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE,
+                        help="Wishlists created by each request of the seeding, at most MAX_BATCH_SIZE of the service")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the random choices of the clients")
+    parser.add_argument("--profile", default="single", help="GUNICORN_PROFILE of the service")
+    parser.add_argument("--url", help="Send the requests to this running service instead of starting one")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--output", help="File to save the results to, default benchmarks/results/loadtest-<commit>.json")
+    parser.add_argument("--compare", help="Results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    env = server_environment()
+    process = None
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        args.host, args.port = url.hostname, url.port or 80
+        database = "unknown"
+    else:
+        database = env["DATABASE_URI"].split(":", 1)[0]
+        process = start_server(args, env)
+    try:
+        print("{} clients for {}s after {}s of warm up, mix {}".format(
+            args.concurrency, args.duration, args.warmup, args.mix))
+        recorder = run(args)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    endpoints, total = recorder.summary(args.duration)
+    if total is None:
+        sys.exit("No request was sent")
+
+    revision, dirty = commit()
+    results = {
+        "commit": revision,
+        "dirty": dirty,
+        "time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "database": database,
+        "profile": None if args.url else args.profile,
+        "settings": {name: getattr(args, name) for name in
+                     ("concurrency", "duration", "warmup", "mix", "customers", "wishlists", "products", "seed")},
+        "total": total,
+        "endpoints": endpoints,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as results_file:
+            baseline = json.load(results_file)
+    print_results(endpoints, total, baseline)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, "loadtest-{}{}.json".format(revision, "-dirty" if dirty else ""))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+    print("Saved the results to {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
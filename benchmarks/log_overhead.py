@@ -0,0 +1,130 @@
+"""
+Benchmark of the cost of logging per request
+
+Sends the same requests through the app with each logging setup and
+prints the time per request and how much of it is logging:
+
+    off          - INFO logs turned off, the baseline
+    sync         - text lines written to the log file by the request, as before
+    async        - text lines written by the background thread of service.logs
+    async-json   - JSON lines written by the background thread
+    sampled      - JSON lines, INFO logs of 10% of the requests
+
+"drained" includes the time the background thread needs to write out what
+is still queued at the end of a run.
+
+Run it with:
+    python benchmarks/log_overhead.py --requests 2000
+    python benchmarks/log_overhead.py --write-delay 0.2
+
+--write-delay makes every write to the log take that many milliseconds
+longer, like a pipe to a log collector that falls behind.
+
+The database is a temporary SQLite file unless BENCHMARK_DATABASE_URI is
+set, never DATABASE_URI, see benchmarks/database.py. The logs are written
+to a temporary file.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+import database
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+database.use_benchmark_database()
+
+from service import app, logs  # noqa: E402
+from service.models import Wishlist, Product  # noqa: E402
+
+SETUPS = {
+    "off": None,
+    "sync": {"LOG_ASYNC": False, "LOG_FORMAT": "text", "LOG_SAMPLE_RATE": 1.0},
+    "async": {"LOG_ASYNC": True, "LOG_FORMAT": "text", "LOG_SAMPLE_RATE": 1.0},
+    "async-json": {"LOG_ASYNC": True, "LOG_FORMAT": "json", "LOG_SAMPLE_RATE": 1.0},
+    "sampled": {"LOG_ASYNC": True, "LOG_FORMAT": "json", "LOG_SAMPLE_RATE": 0.1},
+}
+
+
+class SlowFileHandler(logging.FileHandler):
+    """FileHandler whose writes take delay seconds longer"""
+
+    def __init__(self, filename, delay):
+        super().__init__(filename)
+        self.write_delay = delay
+
+    def emit(self, record):
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        super().emit(record)
+
+
+def seed(products):
+    """Creates one Wishlist with products and returns its id"""
+    wishlist = Wishlist(name="benchmark", customer_id=1)
+    wishlist.products = [Product(item_id=item, name="product {}".format(item), purchased=False)
+                         for item in range(products)]
+    return Wishlist.create_batch([wishlist])[0]
+
+
+def configure(name, log_file, write_delay=0):
+    """Sets up the app logger for one of the SETUPS and returns the queue handler, if any"""
+    for handler in app.logger.handlers:
+        if isinstance(handler, logs.AsyncHandler):
+            handler.stop()
+    app.logger.handlers = []
+    app.logger.filters = []
+    if SETUPS[name] is None:
+        app.logger.setLevel(logging.WARNING)
+        return None
+    app.logger.setLevel(logging.INFO)
+    app.config.update(SETUPS[name])
+    logs.init_app(app, [SlowFileHandler(log_file, write_delay)])
+    return next((handler for handler in app.logger.handlers if isinstance(handler, logs.AsyncHandler)), None)
+
+
+def run(client, path, requests, handler):
+    """Sends the requests, returns the seconds they took and the seconds until the logs were written"""
+    started = time.perf_counter()
+    for _ in range(requests):
+        client.get(path)
+    answered = time.perf_counter() - started
+    if handler is not None:
+        # returns once the thread has written everything that is queued
+        handler.stop()
+    return answered, time.perf_counter() - started
+
+
+def main():
+    """Runs the benchmark and prints the time per request"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="Requests in each run")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per setup, the best one is reported")
+    parser.add_argument("--products", type=int, default=10, help="Products in the Wishlist")
+    parser.add_argument("--path", default="/wishlists/{id}", help="Route to request, {id} is the Wishlist id")
+    parser.add_argument("--write-delay", type=float, default=0, help="Milliseconds added to every write to the log")
+    args = parser.parse_args()
+    log_file = os.path.join(tempfile.mkdtemp(), "service.log")
+
+    with app.app_context(), database.benchmark_tables():
+        path = args.path.format(id=seed(args.products))
+        client = app.test_client()
+        client.get(path)
+        print("GET {}, {} requests, {}ms per write, logs in {}".format(
+            path, args.requests, args.write_delay, log_file))
+        print("{:12} {:>12} {:>12} {:>14}".format("setup", "us/request", "drained", "logging us"))
+        baseline = None
+        for name in SETUPS:
+            best, drained = min(
+                run(client, path, args.requests, configure(name, log_file, args.write_delay / 1000)) for _ in range(args.repeat)
+            )
+            best, drained = best / args.requests * 1e6, drained / args.requests * 1e6
+            baseline = best if baseline is None else baseline
+            print("{:12} {:12.1f} {:12.1f} {:14.1f}".format(name, best, drained, best - baseline))
+        configure("off", log_file)
+
+
+if __name__ == "__main__":
+    main()
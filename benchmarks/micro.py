@@ -0,0 +1,219 @@
+"""
+Micro-benchmarks of the model code on the hot paths
+
+Times each of these on a Wishlist with 1, 100 and 10000 Products:
+
+    wishlist_serialize    - Wishlist.serialize() with its Products
+    wishlist_deserialize  - Wishlist().deserialize() of a body with nested Products
+    product_serialize     - Product.serialize() of every Product of the Wishlist
+    find_by_customer      - Wishlist.find_by_customer().all(), which loads the Products too
+
+and compares them with a baseline saved earlier on the same machine:
+
+    python benchmarks/micro.py --save        # on the commit to compare with
+    python benchmarks/micro.py --check       # on the change, exits with status 1 if a case regressed
+
+The baseline is kept in benchmarks/results/, which is not committed: times
+measured on one machine say nothing about another one. Without a baseline
+--check says so and exits with status 0.
+
+Every case is timed in --rounds rounds through all of them, right after a
+fixed pure Python workload whose time it is divided by, and the median
+round is compared. How far the rounds of a case spread, in the baseline
+and in this run, is the noise of that case on this machine: a case only
+counts as slower when its median moved by more than that noise, and at
+least by MIN_MARGIN. --margin, or BENCHMARK_MARGIN, sets one margin for
+every case instead. find_by_customer is only compared with a baseline
+measured on the same kind of database.
+
+The database is a temporary SQLite file unless BENCHMARK_DATABASE_URI is
+set, never DATABASE_URI, see benchmarks/database.py.
+"""
+import gc
+import os
+import sys
+import json
+import logging
+import argparse
+import platform
+import timeit
+import statistics
+
+import database
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+database.use_benchmark_database()
+
+from service import app  # noqa: E402
+from service.models import db, Wishlist  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "micro-baseline.json")
+# a case is never reported for changes smaller than this share, however quiet the machine
+MIN_MARGIN = 0.25
+SIZES = (1, 100, 10000)
+# cases that read from the database, their times depend on which one it is
+DATABASE_CASES = ("find_by_customer",)
+
+
+def calibration():
+    """A fixed pure Python workload the times of the cases are divided by"""
+    data = {"items": [{"id": number, "name": "item {}".format(number)} for number in range(1000)]}
+    return sum(len(item["name"]) for item in data["items"])
+
+
+def wishlist_data(customer_id, products):
+    """Returns the body of a Wishlist with products"""
+    return {
+        "name": "wishlist of {}".format(customer_id),
+        "customer_id": customer_id,
+        "products": [
+            {"item_id": item, "name": "product {}".format(item), "purchased": item % 2 == 0}
+            for item in range(products)
+        ],
+    }
+
+
+def cases():
+    """Seeds a Wishlist of each size and returns {name: function} of the cases"""
+    # the size is the customer id, so every customer has exactly one Wishlist
+    Wishlist.create_batch([Wishlist().deserialize(wishlist_data(size, size)) for size in SIZES])
+    wishlists = {size: Wishlist.find_by_customer(size).one() for size in SIZES}
+    # detached, so that no later commit expires what was loaded
+    db.session.expunge_all()
+    functions = {}
+    for size, wishlist in wishlists.items():
+        data = wishlist_data(size, size)
+        functions["wishlist_serialize/{}".format(size)] = wishlist.serialize
+        functions["wishlist_deserialize/{}".format(size)] = lambda data=data: Wishlist().deserialize(data)
+        functions["product_serialize/{}".format(size)] = (
+            lambda products=wishlist.products: [product.serialize() for product in products]
+        )
+        functions["find_by_customer/{}".format(size)] = lambda size=size: find_by_customer(size)
+    return functions
+
+
+def find_by_customer(customer_id):
+    """Loads the Wishlists of a customer with a new session, as a request would"""
+    try:
+        return Wishlist.find_by_customer(customer_id).all()
+    finally:
+        db.session.remove()
+
+
+def best_time(function, repeat):
+    """Returns the best seconds per call out of repeat runs of about 0.2 seconds each"""
+    # timeit turns the garbage collector off, the cycles the ORM objects of
+    # the last case left behind would otherwise slow the next one down
+    gc.collect()
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def measure(repeat, rounds):
+    """Times every case in rounds, and the calibration right before it, returns the median round of each"""
+    results = {
+        "python": platform.python_version(),
+        "database": db.engine.dialect.name,
+        "cases": {},
+    }
+    with database.benchmark_tables():
+        functions = cases()
+        rounds_of = {name: [] for name in functions}
+        # every round goes through all of the cases, so that a moment in which
+        # the machine is busy spoils one round of a case and not all of them
+        for _ in range(rounds):
+            for name, function in functions.items():
+                calibration_seconds = best_time(calibration, repeat)
+                seconds = best_time(function, repeat)
+                rounds_of[name].append({
+                    "seconds": seconds,
+                    "calibration_seconds": calibration_seconds,
+                    "relative": seconds / calibration_seconds,
+                })
+    for name, measured in rounds_of.items():
+        relatives = sorted(result["relative"] for result in measured)
+        median = statistics.median(relatives)
+        results["cases"][name] = {
+            "seconds": statistics.median(result["seconds"] for result in measured),
+            "calibration_seconds": statistics.median(result["calibration_seconds"] for result in measured),
+            "relative": median,
+            # the run to run noise of the case on this machine
+            "spread": (relatives[-1] - relatives[0]) / median,
+        }
+    return results
+
+
+def case_margin(result, old, margin):
+    """Returns the share by which a case may be slower than its baseline"""
+    if margin is not None:
+        return margin
+    return max(MIN_MARGIN, result["spread"], old.get("spread", 0))
+
+
+def compare(results, baseline, margin):
+    """Prints every case next to its baseline and returns the names of the ones that regressed"""
+    regressions = []
+    print("{:28} {:>12} {:>12} {:>8} {:>8}".format("case", "us/call", "baseline us", "change", "margin"))
+    for name, result in results["cases"].items():
+        old = baseline["cases"].get(name) if baseline else None
+        if old is None:
+            print("{:28} {:12.1f} {:>12} {:>8}".format(name, result["seconds"] * 1e6, "-", "new"))
+            continue
+        if name.split("/")[0] in DATABASE_CASES and baseline["database"] != results["database"]:
+            print("{:28} {:12.1f} {:>12} {:>8}".format(name, result["seconds"] * 1e6, "-", baseline["database"]))
+            continue
+        change = result["relative"] / old["relative"] - 1
+        allowed = case_margin(result, old, margin)
+        regressed = change > allowed
+        if regressed:
+            regressions.append(name)
+        # the old time is scaled to the speed of this machine
+        scaled = old["relative"] * result["calibration_seconds"]
+        print("{:28} {:12.1f} {:12.1f} {:+8.0%} {:8.0%}{}".format(
+            name, result["seconds"] * 1e6, scaled * 1e6, change, allowed, "  SLOWER" if regressed else ""))
+    return regressions
+
+
+def main():
+    """Runs the micro-benchmarks and compares them with the baseline"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 if a case is slower than allowed")
+    parser.add_argument("--margin", type=float,
+                        default=float(os.environ["BENCHMARK_MARGIN"]) if os.getenv("BENCHMARK_MARGIN") else None,
+                        help="Share by which every case may be slower than its baseline, or BENCHMARK_MARGIN, "
+                             "by default the noise measured for each case")
+    parser.add_argument("--save", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline file, saved on this machine")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing runs per case in each round")
+    parser.add_argument("--rounds", type=int, default=5, help="Rounds through all of the cases, the median one is used")
+    args = parser.parse_args()
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    elif args.check and not args.save:
+        print("No baseline at {}, skipping the check. Save one on this machine with --save".format(args.baseline))
+        return
+    with app.app_context():
+        results = measure(args.repeat, args.rounds)
+    print("Python {python}, {database}".format(**results))
+    regressions = compare(results, baseline, args.margin)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("Saved the baseline to {}".format(args.baseline))
+    elif regressions:
+        print("{} case(s) slower than the baseline by more than their margin: {}".format(
+            len(regressions), ", ".join(regressions)))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Bulk seeding of the database with synthetic Wishlists and Products
+
+Generates customers with Wishlists and Products, in the numbers drawn from
+the given distributions, and loads them in chunks with COPY on Postgres
+and with executemany on SQLite and other databases, so that performance
+tests can run against tables of production size. The names are taken from
+tests/factories.py.
+
+A distribution is one of:
+    N               - always N
+    uniform:A-B     - any number from A to B, all as likely
+    exponential:M   - M on average, mostly fewer and a long tail of many
+
+Run it with:
+    DATABASE_URI=postgresql://... python benchmarks/seed.py --wishlists 1000000
+    python benchmarks/seed.py --wishlists 100000 --wishlists-per-customer exponential:3 \\
+        --products-per-wishlist uniform:0-20 --purchased-ratio 0.2
+
+The database must have been migrated with `flask db upgrade`. The rows are
+added to the ones already there, --truncate removes every Wishlist and
+Product first. Restart the service or clear its cache afterwards.
+"""
+import io
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select, text  # noqa: E402
+from service import app  # noqa: E402
+from service.models import db, Wishlist, Product  # noqa: E402
+from tests.factories import products as PRODUCT_NAMES, wishlist_names as WISHLIST_NAMES  # noqa: E402
+
+WISHLIST_COLUMNS = ("id", "customer_id", "name", "version")
+PRODUCT_COLUMNS = ("id", "wishlist_id", "item_id", "name", "purchased")
+
+
+def distribution(spec):
+    """Parses a distribution into a function that draws a number from a random.Random"""
+    kind, _, value = spec.partition(":")
+    try:
+        if not value:
+            number = int(kind)
+            return lambda rng: number
+        if kind == "uniform":
+            low, high = (int(part) for part in value.split("-"))
+            return lambda rng: rng.randint(low, high)
+        if kind == "exponential":
+            mean = float(value)
+            return lambda rng: int(rng.expovariate(1.0 / mean) + 0.5)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError("'{}' is not N, uniform:A-B or exponential:M".format(spec))
+
+
+def next_ids():
+    """Returns the first free Wishlist id, Product id and customer id"""
+    return tuple(
+        (db.session.execute(select([func.max(column)])).scalar() or 0) + 1
+        for column in (Wishlist.id, Product.id, Wishlist.customer_id)
+    )
+
+
+def generate(args, wishlist_id, product_id, customer_id, rng):
+    """Yields chunks of (wishlist rows, product rows) until args.wishlists are made"""
+    wishlists, products = [], []
+    made = 0
+    while made < args.wishlists:
+        count = min(max(1, args.wishlists_per_customer(rng)), args.wishlists - made)
+        for _ in range(count):
+            wishlists.append((wishlist_id, customer_id, rng.choice(WISHLIST_NAMES), 1))
+            for _ in range(args.products_per_wishlist(rng)):
+                item_id = rng.randint(1, args.catalog)
+                name = "{} {}".format(PRODUCT_NAMES[item_id % len(PRODUCT_NAMES)], item_id)
+                products.append((product_id, wishlist_id, item_id, name, rng.random() < args.purchased_ratio))
+                product_id += 1
+            wishlist_id += 1
+        made += count
+        customer_id += 1
+        if len(wishlists) >= args.chunk_size or made == args.wishlists:
+            yield wishlists, products
+            wishlists, products = [], []
+
+
+def copy_rows(connection, table, columns, rows):
+    """Loads rows into a Postgres table with COPY"""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(str(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert("COPY {} ({}) FROM STDIN".format(table.name, ", ".join(columns)), buffer)
+    cursor.close()
+
+
+def insert_rows(connection, table, columns, rows):
+    """Loads rows into a table with one executemany"""
+    if rows:
+        connection.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+def truncate(connection, postgres):
+    """Removes every Wishlist and Product"""
+    if postgres:
+        connection.execute(text("TRUNCATE product, wishlist RESTART IDENTITY"))
+    else:
+        connection.execute(Product.__table__.delete())
+        connection.execute(Wishlist.__table__.delete())
+
+
+def main():
+    """Generates the rows and loads them"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wishlists", type=int, default=100000, help="Wishlists to create")
+    parser.add_argument("--wishlists-per-customer", type=distribution, default=distribution("exponential:2"),
+                        help="Distribution of the Wishlists of a customer, at least 1, default exponential:2")
+    parser.add_argument("--products-per-wishlist", type=distribution, default=distribution("exponential:10"),
+                        help="Distribution of the Products of a Wishlist, default exponential:10")
+    parser.add_argument("--purchased-ratio", type=float, default=0.1, help="Share of the Products that were purchased")
+    parser.add_argument("--catalog", type=int, default=100000, help="Different item ids the Products are picked from")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="Wishlists loaded in each transaction")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the random numbers")
+    parser.add_argument("--truncate", action="store_true", help="Remove every Wishlist and Product first")
+    args = parser.parse_args()
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+
+    with app.app_context():
+        engine = db.engine
+        postgres = engine.dialect.name == "postgresql"
+        load = copy_rows if postgres else insert_rows
+        if args.truncate:
+            with engine.begin() as connection:
+                truncate(connection, postgres)
+        wishlist_id, product_id, customer_id = next_ids()
+        db.session.remove()
+        print("Loading {} Wishlists into {} with {}".format(
+            args.wishlists, engine.dialect.name, "COPY" if postgres else "executemany"))
+        started = time.perf_counter()
+        wishlists = products = 0
+        for wishlist_rows, product_rows in generate(args, wishlist_id, product_id, customer_id,
+                                                    random.Random(args.seed)):
+            with engine.begin() as connection:
+                load(connection, Wishlist.__table__, WISHLIST_COLUMNS, wishlist_rows)
+                load(connection, Product.__table__, PRODUCT_COLUMNS, product_rows)
+            wishlists += len(wishlist_rows)
+            products += len(product_rows)
+            seconds = time.perf_counter() - started
+            print("\r{} Wishlists, {} Products, {:.0f} rows/s".format(
+                wishlists, products, (wishlists + products) / seconds), end="", flush=True)
+        print()
+        with engine.begin() as connection:
+            if postgres:
+                # the ids were given by us, move the sequences past them
+                for table in ("wishlist", "product"):
+                    connection.execute(text(
+                        "SELECT setval(pg_get_serial_sequence('{0}', 'id'), (SELECT MAX(id) FROM {0}))".format(table)
+                    ))
+            # fresh statistics, so the planner sees the tables as they are now
+            connection.execute(text("ANALYZE"))
+        print("Loaded in {:.1f}s".format(time.perf_counter() - started))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark of the list route serialization
+
+Compares the old path, which loads Wishlist objects, calls serialize() and
+marshals the result with the Swagger model before encoding it, with the
+fast path, which builds the same dictionaries from rows and encodes them
+with service.serializers.
+
+Run it with:
+    python benchmarks/serialization.py --wishlists 100 --products 20
+
+The database is a temporary SQLite file unless BENCHMARK_DATABASE_URI is
+set, never DATABASE_URI, see benchmarks/database.py.
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+import timeit
+
+import database
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+database.use_benchmark_database()
+
+from flask_restx import marshal  # noqa: E402
+from service import app, serializers  # noqa: E402
+from service.models import db, Wishlist, Product  # noqa: E402
+from service.routes import wishlist_model  # noqa: E402
+
+
+def seed(wishlists, products):
+    """Creates wishlists with products each"""
+    batch = []
+    for number in range(wishlists):
+        wishlist = Wishlist(name="wishlist {}".format(number), customer_id=number % 50)
+        wishlist.products = [
+            Product(item_id=item, name="product {}".format(item), purchased=False) for item in range(products)
+        ]
+        batch.append(wishlist)
+    Wishlist.create_batch(batch)
+
+
+def marshalled_page(limit):
+    """The old path: objects, serialize(), marshal() and json.dumps()"""
+    db.session.remove()
+    wishlists, _ = Wishlist.page(limit)
+    return json.dumps(marshal([wishlist.serialize() for wishlist in wishlists], wishlist_model))
+
+
+def fast_page(limit):
+    """The fast path: rows straight to dictionaries and serializers.dumps()"""
+    db.session.remove()
+    rows, _ = Wishlist.page(limit, query=Wishlist.with_columns())
+    return serializers.dumps(Wishlist.serialize_rows(rows))
+
+
+def main():
+    """Runs the benchmark and prints the time per page"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wishlists", type=int, default=100, help="Wishlists on the page")
+    parser.add_argument("--products", type=int, default=20, help="Products in each Wishlist")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing runs, the best one is reported")
+    parser.add_argument("--number", type=int, default=20, help="Pages serialized in each run")
+    args = parser.parse_args()
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+
+    with app.app_context(), database.benchmark_tables():
+        seed(args.wishlists, args.products)
+        if json.loads(marshalled_page(args.wishlists)) != json.loads(fast_page(args.wishlists)):
+            sys.exit("The two paths returned different JSON")
+        print("{} wishlists x {} products, encoder {}".format(
+            args.wishlists, args.products, serializers.encoder_name()))
+        results = {}
+        for name, function in (("marshal", marshalled_page), ("fast", fast_page)):
+            best = min(timeit.repeat(lambda: function(args.wishlists), repeat=args.repeat, number=args.number))
+            results[name] = best / args.number
+            print("{:8} {:8.2f} ms per page".format(name, results[name] * 1000))
+        print("speedup  {:8.1f}x".format(results["marshal"] / results["fast"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,76 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Database connection pool, pool_size, max_overflow and pool_timeout do not
+# apply to SQLite
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    # seconds to wait for a free connection before answering 503
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "5")),
+    # seconds after which a connection is replaced, -1 to keep them forever
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+}
+# Seconds a client is asked to wait with Retry-After when no connection was free
+DB_POOL_RETRY_AFTER = int(os.getenv("DB_POOL_RETRY_AFTER", "1"))
+# Seconds to wait for a new connection to a Postgres primary or replica
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+# Connections opened by the warm up of each worker before its first request,
+# no more than pool_size are kept
+DB_WARM_UP_CONNECTIONS = int(os.getenv("DB_WARM_UP_CONNECTIONS", "1"))
+# Seconds between the background checks behind GET /health/ready
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "5"))
+
+# Optional read replica, the reads of GET requests go to it when it is set
+REPLICA_DATABASE_URI = os.getenv("REPLICA_DATABASE_URI")
+SQLALCHEMY_BINDS = {"replica": REPLICA_DATABASE_URI} if REPLICA_DATABASE_URI else {}
+# Seconds a client reads from the primary after it changed something
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+# Seconds the replica may lag behind before reads go back to the primary
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "2"))
+# Seconds between checks of the health and lag of the replica
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+
+# SQL statements slower than this many seconds are logged with their parameters
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "0.5"))
+# Requests that run more SQL statements than this are logged, 0 turns it off
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "20"))
+
+# Keyset pagination for the collection routes
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Shortest text GET /wishlists/search accepts, the trigram indexes need 3
+SEARCH_MIN_LENGTH = int(os.getenv("SEARCH_MIN_LENGTH", "3"))
+
+# Largest number of Wishlists accepted by POST /wishlists/batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+# Most Products the Wishlists of one batch may have in all, they are inserted in one transaction
+MAX_BATCH_PRODUCTS = int(os.getenv("MAX_BATCH_PRODUCTS", "10000"))
+
+# Number of Wishlists fetched per round trip by the NDJSON export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+# Read-through cache for single Wishlist reads: local, redis or none
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Logging: text or json lines, written by a background thread when LOG_ASYNC is on
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+# Records waiting to be written, more are dropped instead of blocking requests
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Share of the requests whose INFO logs are kept, per route with
+# "WishlistCollection=0.1,WishlistResource=0.01" and for all other routes
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+# Log the body of requests, it may hold customer data
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "false").lower() == "true"
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
@@ -1,6 +1,122 @@
+"""
+Gunicorn configuration for the Wishlist service
+
+The number of workers and threads comes from a profile picked with
+GUNICORN_PROFILE:
+    single   - one sync worker, the default, fits a 128M container
+    sync     - 2 x CPUs + 1 sync workers
+    threaded - CPUs + 1 gthread workers with GUNICORN_THREADS threads each
+
+GUNICORN_WORKERS and GUNICORN_THREADS override the sizes of any profile.
+
+The app is imported once in the master (preload_app) and the workers are
+forked from it. The hooks below make that safe for the database: the
+master gives up its pooled connections before forking and every worker
+starts with an empty pool, so no connection is shared between processes.
+Every worker then opens one connection per thread in the background and
+keeps checking the database for GET /health/ready, see service/health.py.
+
+With more than one worker the Prometheus metrics are kept in files in
+PROMETHEUS_MULTIPROC_DIR, so that /metrics can add up the requests of
+every worker. A configured directory is emptied when gunicorn starts,
+otherwise a temporary one is made and removed again when it exits.
+"""
+import gc
 import os
+import glob
+import shutil
+import tempfile
+import multiprocessing
 
 PORT = os.getenv("PORT", "8080")
 bind = "0.0.0.0:" + PORT
-workers = 1
 log_level = "info"
+
+CPUS = multiprocessing.cpu_count()
+PROFILES = {
+    "single": {"workers": 1, "threads": 1},
+    "sync": {"workers": 2 * CPUS + 1, "threads": 1},
+    "threaded": {"workers": CPUS + 1, "threads": 4},
+}
+PROFILE = os.getenv("GUNICORN_PROFILE", "single")
+if PROFILE not in PROFILES:
+    raise ValueError("Unknown GUNICORN_PROFILE '{}', use one of {}".format(PROFILE, ", ".join(PROFILES)))
+
+workers = int(os.getenv("GUNICORN_WORKERS", PROFILES[PROFILE]["workers"]))
+# each thread needs its own database connection, keep the pool at least this big
+threads = int(os.getenv("GUNICORN_THREADS", PROFILES[PROFILE]["threads"]))
+worker_class = "gthread" if threads > 1 else "sync"
+
+# every thread of a worker finds a connection in the pool from the start
+os.environ.setdefault("DB_WARM_UP_CONNECTIONS", str(threads))
+
+# must be set before the app, and prometheus_client, is imported. The
+# directory made here is kept in the environment too, because a reload
+# runs this file again and must neither make another one nor forget it
+if workers > 1 and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="wishlist-metrics-")
+    os.environ["WISHLIST_METRICS_TEMP_DIR"] = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+# load the app in the master so the workers share its memory copy-on-write
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+
+def dispose_engine():
+    """Drops the pooled database connections of this process"""
+    from service import app
+    from service.models import db
+    with app.app_context():
+        for bind in [None] + list(app.config["SQLALCHEMY_BINDS"] or ()):
+            db.get_engine(app, bind=bind).dispose()
+
+
+def on_starting(server):
+    """Runs in the master before the workers start, removes the metrics of the last run"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+            os.remove(path)
+
+
+def on_exit(server):
+    """Runs in the master when gunicorn stops, removes the metrics directory it made"""
+    temp_dir = os.environ.get("WISHLIST_METRICS_TEMP_DIR")
+    if temp_dir and temp_dir == os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def when_ready(server):
+    """Runs in the master after the app is loaded, before the workers are forked"""
+    if preload_app:
+        dispose_engine()
+        # move everything loaded so far out of the garbage collector, so that
+        # collections in the workers do not touch, and copy, the shared pages
+        gc.freeze()
+    server.log.info("Profile %s: %s %s worker(s) with %s thread(s)", PROFILE, workers, worker_class, threads)
+
+
+def post_fork(server, worker):
+    """Runs in each worker right after it is forked"""
+    if preload_app:
+        # a connection made by the master must never be used by two processes
+        dispose_engine()
+
+
+def post_worker_init(worker):
+    """Runs in each worker once the app is loaded, starts its log writer, pool warm up and replica checks"""
+    from service import app, logs
+    from service.health import health
+    from service.replica import replica_configured, replica_monitor
+    logs.start(app)
+    health.start()
+    if replica_configured(app):
+        replica_monitor.start()
+
+
+def child_exit(server, worker):
+    """Runs in the master when a worker exits"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        # drops the in-flight requests of the worker, its counters are kept
+        multiprocess.mark_process_dead(worker.pid)
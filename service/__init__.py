@@ -17,43 +17,53 @@ Package: service
 Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
+
+Importing it does not connect to the database: the first connections are
+opened by the warm up of service/health.py, or by the first request.
 """
 import os
-import sys
 import logging
 from flask import Flask
+from flask_log_request_id import RequestID
 
 # Create Flask application
 app = Flask(__name__)
 app.config.from_object("config")
+# Takes the request id from X-Request-ID or makes one up
+RequestID(app)
 
 # Import the rutes After the Flask app is created
-from service import routes, models, error_handlers
+from service import routes, models, error_handlers, migrations, logs
+from service.cache import cache
+from service.metrics import metrics
+from service.tracing import tracer
+from service.health import health
+from service.replica import replica_monitor
+
+# Schema changes are applied with `flask db upgrade` instead of at startup
+app.cli.add_command(migrations.db_cli)
 
 # Set up logging for production
 print("Setting up logging for {}...".format(__name__))
 app.logger.propagate = False
 if __name__ != "__main__":
     gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
+    # Make all log formats consistent, and write them from a background thread
+    logs.init_app(app, gunicorn_logger.handlers)
     app.logger.info("Logging handler established")
 
 app.logger.info(70 * "*")
 app.logger.info("  W I S H L I S T   S E R V I C E  ".center(70, "*"))
 app.logger.info(70 * "*")
 
-try:
-    models.init_db(app)  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
+cache.init_app(app)
+metrics.init_app(app)
+tracer.init_app(app)
+health.init_app(app)
+replica_monitor.init_app(app)
+
+# Only configures SQLAlchemy, the connections are opened when they are needed
+models.db.init_app(app)
 
 app.logger.info("Service inititalized!")
@@ -0,0 +1,192 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Module: cache
+
+Read-through cache for serialized Wishlists
+
+The backend is picked with CACHE_BACKEND:
+    local - an in process LRU cache with a time to live (the default)
+    redis - a cache shared by every worker, needs the redis package
+    none  - caching is turned off
+
+The routes put the version of a Wishlist in its key, so every worker
+only returns an entry that matches the row in the database and writes do
+not have to remove anything. The cache counts its hits and misses so they
+can be monitored.
+"""
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+
+class LocalBackend():
+    """ In process LRU cache where every entry expires after ttl seconds """
+
+    name = "local"
+
+    def __init__(self, max_entries=10000, ttl=60, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Returns the value for a key, None if it is missing or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self._clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """ Stores a value, evicting the least recently used entries when full """
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Removes everything from the cache """
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend():
+    """
+    Cache shared by every worker, stored in Redis with a time to live
+
+    Any client with the get, setex, delete and scan_iter methods of
+    redis.Redis can be used. The size limit and eviction policy are set on
+    the Redis server with maxmemory and maxmemory-policy allkeys-lru.
+    """
+
+    name = "redis"
+
+    def __init__(self, client, ttl=60, prefix="wishlist-service:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        """ Returns the value for a key, None if it is missing or expired """
+        data = self.client.get(self.prefix + key)
+        return None if data is None else json.loads(data)
+
+    def set(self, key, value):
+        """ Stores a value that expires after ttl seconds """
+        self.client.setex(self.prefix + key, self.ttl, json.dumps(value))
+
+    def clear(self):
+        """ Removes every key of this service from the cache """
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class NullBackend():
+    """ Backend that never stores anything, used to turn caching off """
+
+    name = "none"
+
+    def get(self, key):
+        """ Always misses """
+        return None
+
+    def set(self, key, value):
+        """ Does nothing """
+
+    def clear(self):
+        """ Does nothing """
+
+
+class Cache():
+    """ Counts the hits and misses of a pluggable cache backend """
+
+    def __init__(self, backend=None):
+        self.backend = backend or LocalBackend()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """ Creates the backend that is configured for the app """
+        name = app.config.get("CACHE_BACKEND", "local")
+        ttl = app.config.get("CACHE_TTL", 60)
+        if name == "local":
+            self.backend = LocalBackend(app.config.get("CACHE_MAX_ENTRIES", 10000), ttl)
+        elif name == "redis":
+            import redis  # only needed for the shared backend
+            client = redis.Redis.from_url(app.config["CACHE_REDIS_URL"])
+            self.backend = RedisBackend(client, ttl)
+        elif name == "none":
+            self.backend = NullBackend()
+        else:
+            raise ValueError("Unknown CACHE_BACKEND '{}'".format(name))
+        logger.info("Using the %s cache backend", name)
+
+    def get(self, key):
+        """ Returns the cached value for a key or None on a miss """
+        try:
+            value = self.backend.get(key)
+        except Exception as error:  # a broken cache must not break reads
+            logger.warning("Cache get failed: %s", error)
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """ Stores a value in the cache """
+        try:
+            self.backend.set(key, value)
+        except Exception as error:
+            logger.warning("Cache set failed: %s", error)
+
+    def clear(self):
+        """ Invalidates everything and resets the counters """
+        self.backend.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Returns the hit and miss counters """
+        stats = {"backend": self.backend.name, "hits": self.hits, "misses": self.misses}
+        if isinstance(self.backend, LocalBackend):
+            stats["entries"] = len(self.backend)
+            stats["max_entries"] = self.backend.max_entries
+        return stats
+
+
+# The cache used by the routes, its backend is set up by init_app()
+cache = Cache()
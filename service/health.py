@@ -0,0 +1,146 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Module: health
+
+Liveness and readiness of the service
+
+Importing the service does not connect to the database. A background
+thread, started in every gunicorn worker by gunicorn.conf.py or by the
+first readiness probe, opens DB_WARM_UP_CONNECTIONS connections so that
+the first requests find them in the pool, and then checks every
+HEALTH_CHECK_INTERVAL seconds that the database answers. The readiness
+probe only returns the result of the last check, so probes never wait
+for, or add load to, the database.
+"""
+import os
+import time
+import threading
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+from service.models import db
+
+
+class HealthChecker():
+    """ Readiness of this process, checked by a background thread """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 5.0
+        self.warm_up_connections = 1
+        self.reset()
+        # a thread does not survive a fork, every gunicorn worker starts its own
+        os.register_at_fork(after_in_child=self.reset)
+
+    def init_app(self, app):
+        """ Reads the settings of the app """
+        self.app = app
+        self.interval = app.config.get("HEALTH_CHECK_INTERVAL", 5.0)
+        self.warm_up_connections = app.config.get("DB_WARM_UP_CONNECTIONS", 1)
+
+    def reset(self):
+        """ Forgets the thread and the last check """
+        self._lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.warmed_up = False
+        self.ready = False
+        self.checked_at = None
+        self.error = None
+
+    def start(self):
+        """ Starts the background checks unless they already run in this process """
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="health-check", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """ Stops the background checks """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.reset()
+
+    def run(self):
+        """ Checks the database every interval until stopped """
+        while not self.stopping.is_set():
+            self.check()
+            self.stopping.wait(self.interval)
+
+    def engine(self):
+        """ Returns the engine of the primary database """
+        return db.get_engine(self.app)
+
+    def check(self):
+        """ Warms the pool up the first time, then checks that the database answers """
+        engine = self.engine()
+        try:
+            if not self.warmed_up:
+                self.warm_up(engine)
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except SQLAlchemyError as error:
+            if self.ready or self.checked_at is None:
+                self.app.logger.warning("Not ready, the database does not answer: %s", error)
+            self.ready, self.error = False, str(error)
+        else:
+            if not self.ready:
+                self.app.logger.info("Ready, the database answers")
+            self.ready, self.error = True, None
+        self.checked_at = time.monotonic()
+
+    def warm_up(self, engine):
+        """ Opens the first connections of the pool so that requests do not wait for them """
+        count = 1
+        if isinstance(engine.pool, QueuePool):
+            # the pool keeps at most pool_size connections once they are returned
+            count = max(1, min(self.warm_up_connections, engine.pool.size()))
+        started = time.perf_counter()
+        connections = []
+        try:
+            for _ in range(count):
+                connections.append(engine.connect())
+        finally:
+            for connection in connections:
+                connection.close()
+        self.warmed_up = True
+        self.app.logger.info("Opened %s database connection(s) in %.3fs", count, time.perf_counter() - started)
+
+    def is_ready(self):
+        """ Returns True if the last check passed and is recent """
+        # a check older than a few intervals means the thread is stuck or gone
+        return (
+            self.ready
+            and self.checked_at is not None
+            and time.monotonic() - self.checked_at < 3 * self.interval
+        )
+
+    def as_dict(self):
+        """ Returns the result of the last check """
+        if self.checked_at is None:
+            status = "starting"
+        else:
+            status = "ready" if self.is_ready() else "not ready"
+        return {
+            "status": status,
+            "checked_seconds_ago": None if self.checked_at is None else round(time.monotonic() - self.checked_at, 3),
+            "error": self.error,
+        }
+
+
+# The health of this process, set up by init_app()
+health = HealthChecker()
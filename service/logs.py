@@ -0,0 +1,207 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Module: logs
+
+Logging pipeline of the service
+
+The request threads only put log records on a queue. A background thread
+formats them, as text or as one JSON object per line, and writes them to
+the real handlers, so a slow stream never holds up a request. When the
+queue is full records are dropped and counted instead of blocking.
+
+Importing the service starts no thread: the writer is started in every
+gunicorn worker by gunicorn.conf.py, or by the first request. Until then,
+as while the service starts, records are written right away.
+
+INFO and DEBUG records can be sampled per route: the decision is made
+once per request, so a request keeps all of its lines or none of them.
+Warnings and errors are always kept.
+"""
+import os
+import copy
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+from flask import g, has_request_context, request
+from flask_log_request_id import current_request_id
+from service.metrics import metrics
+from service.serializers import dumps
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] [%(request_id)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+
+def parse_sample_rates(text):
+    """ Parses "Route=rate,Route=rate" into a dictionary """
+    rates = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        route, _, rate = item.partition("=")
+        rates[route.strip()] = float(rate)
+    return rates
+
+
+class RequestIdFilter(logging.Filter):
+    """ Adds the id of the current request to records that do not have one yet """
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            # g outlives the request when an app context was pushed at startup
+            record.request_id = current_request_id() if has_request_context() else None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one JSON object """
+
+    def format(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        data = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + ".{:03d}Z".format(int(record.msecs)),
+            "level": record.levelname,
+            "module": record.module,
+            "request_id": getattr(record, "request_id", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return dumps(data).decode("utf-8")
+
+
+class SamplingFilter(logging.Filter):
+    """ Keeps the INFO and DEBUG records of a share of the requests of each route """
+
+    def __init__(self, rates, default=1.0):
+        super().__init__()
+        self.rates = rates
+        self.default = default
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not has_request_context():
+            return True
+        sampled = g.get("log_sampled")
+        if sampled is None:
+            rate = self.rates.get(metrics.route(request.endpoint), self.default)
+            sampled = g.log_sampled = rate >= 1.0 or random.random() < rate
+        return sampled
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """ Puts records on a bounded queue that a background thread writes out once started """
+
+    def __init__(self, handlers, max_size=10000):
+        super().__init__(None)
+        self.handlers = handlers
+        self.max_size = max_size
+        self.dropped = 0
+        self.reset()
+        # a thread does not survive a fork, every gunicorn worker starts its own
+        os.register_at_fork(after_in_child=self.reset)
+        atexit.register(self.stop)
+
+    def reset(self):
+        """ Forgets the thread, records are written right away until start() """
+        self._lock = threading.Lock()
+        # SimpleQueue is implemented in C and much cheaper to put on than Queue
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+
+    def start(self):
+        """ Starts the thread that writes the records to the handlers unless it runs already """
+        with self._lock:
+            if self.listener is None:
+                self.listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+                self.listener.start()
+
+    def stop(self):
+        """ Writes the records that are still queued and stops the thread """
+        with self._lock:
+            listener, self.listener = self.listener, None
+            if listener is not None and listener._thread is not None:
+                listener.stop()
+
+    def emit(self, record):
+        if self.listener is None:
+            # no writer thread in this process (yet)
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        super().emit(record)
+
+    def prepare(self, record):
+        """ Returns a copy of the record with the arguments merged into the message """
+        # the caller, and the other handlers, keep the record as it was
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+        else:
+            self.queue.put(record)
+
+
+def init_app(app, handlers):
+    """
+    Sends the log records of the app to handlers
+
+    The records are formatted as text or JSON (LOG_FORMAT), written by a
+    background thread when LOG_ASYNC is on, and the INFO records of the
+    routes in LOG_SAMPLE_RATES are sampled. The thread is started by
+    start(), or by the first request.
+    """
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+    for handler in handlers:
+        handler.addFilter(RequestIdFilter())
+        handler.setFormatter(formatter)
+    if app.config.get("LOG_ASYNC"):
+        handler = AsyncHandler(list(handlers), app.config.get("LOG_QUEUE_SIZE", 10000))
+        # the request id is only known in the request thread
+        handler.addFilter(RequestIdFilter())
+        app.before_first_request(handler.start)
+        handlers = [handler]
+    app.logger.handlers = list(handlers)
+    rates = parse_sample_rates(app.config.get("LOG_SAMPLE_RATES", ""))
+    default = app.config.get("LOG_SAMPLE_RATE", 1.0)
+    if rates or default < 1.0:
+        app.logger.addFilter(SamplingFilter(rates, default))
+        app.teardown_request(forget_sample)
+
+
+def start(app):
+    """ Starts the thread that writes the logs of the app in this process """
+    for handler in app.logger.handlers:
+        if isinstance(handler, AsyncHandler):
+            handler.start()
+
+
+def forget_sample(error):
+    """ Lets the next request make its own sampling decision """
+    g.pop("log_sampled", None)
@@ -0,0 +1,171 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Module: metrics
+
+Prometheus metrics of the requests and of their SQL statements
+
+Every request is counted and timed per route, method and status code. The
+route is the name of the Resource class that answered it, or of the view
+function. SQL statements are counted and timed with SQLAlchemy engine
+events and added up per request. A request is recorded when it is torn
+down, which for a streamed response is after its last chunk was sent, so
+the statements run while streaming count for its route. These are the only cursor events of the
+service: other modules get the duration of every statement from
+observe_statements() instead of timing it again.
+
+When PROMETHEUS_MULTIPROC_DIR is set the metrics are kept in files in that
+directory and /metrics adds up the files of every gunicorn worker. It has
+to be set before prometheus_client is imported, gunicorn.conf.py does that.
+"""
+import os
+import time
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUEST_LATENCY = Histogram(
+    "wishlist_request_duration_seconds", "Time spent answering requests", ["route", "method"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+)
+REQUESTS = Counter(
+    "wishlist_requests_total", "Requests answered", ["route", "method", "status"]
+)
+IN_FLIGHT = Gauge(
+    "wishlist_requests_in_flight", "Requests being answered", multiprocess_mode="livesum"
+)
+DB_QUERIES = Histogram(
+    "wishlist_request_db_queries", "SQL statements run by a request", ["route", "method"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+)
+DB_LATENCY = Histogram(
+    "wishlist_request_db_duration_seconds", "Time a request spent running SQL statements", ["route", "method"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+
+class RequestClock():
+    """ When a request started, the SQL statements it ran so far and its status """
+
+    __slots__ = ("started", "queries", "db_seconds", "status_code")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.status_code = None
+
+
+class Metrics():
+    """ Measures the requests of a Flask app """
+
+    def __init__(self):
+        self._series = {}
+        self.statement_observers = []
+
+    def init_app(self, app):
+        """ Measures every request of the app and serves the metrics at /metrics """
+        self.app = app
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule("/metrics", "metrics", self.render)
+        event.listen(Engine, "before_cursor_execute", self.start_statement)
+        event.listen(Engine, "after_cursor_execute", self.end_statement)
+
+    def observe_statements(self, observer):
+        """ Calls observer(statement, parameters, seconds) after every SQL statement """
+        self.statement_observers.append(observer)
+
+    def start_statement(self, conn, cursor, statement, parameters, context, executemany):
+        """ Starts the clock of a SQL statement """
+        if context is not None:
+            context.statement_started = time.perf_counter()
+
+    def end_statement(self, conn, cursor, statement, parameters, context, executemany):
+        """ Adds a SQL statement to its request and passes its duration on to the observers """
+        started = getattr(context, "statement_started", None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        clock = g.get("request_clock") if has_request_context() else None
+        if clock is not None:
+            clock.queries += 1
+            clock.db_seconds += seconds
+        for observer in self.statement_observers:
+            observer(statement, parameters, seconds)
+
+    def route(self, endpoint):
+        """ Returns the route label of an endpoint """
+        view = self.app.view_functions.get(endpoint)
+        # unknown paths share one label, so a scan does not add a series per path
+        return getattr(view, "view_class", view).__name__ if view else "unmatched"
+
+    def series(self, endpoint, method, status_code):
+        """ Returns the latency, status, query count and SQL time series of a request """
+        key = (endpoint, method, status_code)
+        series = self._series.get(key)
+        if series is None:
+            route = self.route(endpoint)
+            series = self._series[key] = (
+                REQUEST_LATENCY.labels(route, method),
+                REQUESTS.labels(route, method, str(status_code)),
+                DB_QUERIES.labels(route, method),
+                DB_LATENCY.labels(route, method),
+            )
+        return series
+
+    def start_request(self):
+        """ Starts the clock of a request """
+        IN_FLIGHT.inc()
+        g.request_clock = RequestClock()
+
+    def end_request(self, response):
+        """ Keeps the status of a request until it is recorded """
+        g.request_clock.status_code = response.status_code
+        return response
+
+    def teardown_request(self, error):
+        """ Records a request once its response, streamed or not, is done """
+        clock = g.pop("request_clock", None)
+        if clock is None:
+            return
+        # a request that failed before it got a response is a 500
+        self.observe(clock, clock.status_code or 500)
+        IN_FLIGHT.dec()
+
+    def observe(self, clock, status_code):
+        """ Records the time, status and SQL statements of the current request """
+        latency, requests, queries, db_latency = self.series(request.endpoint, request.method, status_code)
+        latency.observe(time.perf_counter() - clock.started)
+        requests.inc()
+        queries.observe(clock.queries)
+        db_latency.observe(clock.db_seconds)
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text format """
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+# The metrics of the service, set up by init_app()
+metrics = Metrics()
@@ -0,0 +1,314 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Module: migrations
+
+Versioned schema migrations for the Wishlist service
+
+Each migration is applied once, in version order, and recorded in the
+schema_migrations table. Migrations look at the schema before changing it
+so they can also bring databases made by the old create_all() at startup
+up to date. A migration only uses the schema as it was at its version,
+never the models, which keep changing.
+
+Commands:
+------
+flask db upgrade - applies the pending migrations
+flask db current - shows the schema version of the database
+"""
+import logging
+import click
+from flask.cli import AppGroup
+from sqlalchemy import MetaData, Table, Column, ForeignKey, Boolean, Integer, String, DateTime, func, inspect, text
+from service.models import db, create_search_index, enable_trigram_extension
+
+logger = logging.getLogger("flask.app")
+
+# Any number will do as long as no other application uses it for an advisory lock
+MIGRATION_LOCK_ID = 7340531
+
+metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(256)),
+    Column("applied_at", DateTime, server_default=func.now()),
+)
+
+# The tables as migration 1 created them
+schema_v1 = MetaData()
+Table(
+    "wishlist",
+    schema_v1,
+    Column("id", Integer, primary_key=True),
+    Column("customer_id", Integer),
+    Column("name", String(128)),
+)
+Table(
+    "product",
+    schema_v1,
+    Column("id", Integer, primary_key=True),
+    Column("wishlist_id", Integer, ForeignKey("wishlist.id"), nullable=False),
+    Column("item_id", Integer),
+    Column("name", String(128)),
+    Column("purchased", Boolean),
+)
+
+# The product table of migration 3, SQLite can only add ON DELETE CASCADE
+# by copying the rows into a new table
+SQLITE_PRODUCT_V3 = (
+    "CREATE TABLE product_new ("
+    "id INTEGER NOT NULL PRIMARY KEY, "
+    "wishlist_id INTEGER NOT NULL REFERENCES wishlist (id) ON DELETE CASCADE, "
+    "item_id INTEGER, "
+    "name VARCHAR(128), "
+    "purchased BOOLEAN, "
+    "CHECK (purchased IN (0, 1)))"
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Registers a function as the migration to a schema version"""
+    def decorator(function):
+        MIGRATIONS.append((version, description, function))
+        return function
+    return decorator
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+@migration(1, "Create the wishlist and product tables")
+def create_tables(engine):
+    """Creates the tables that do not exist yet"""
+    schema_v1.create_all(engine)
+
+
+@migration(2, "Index wishlist.customer_id, product.wishlist_id and product.item_id")
+def create_lookup_indexes(engine):
+    """Adds the indexes used by find_by_customer and the product loads"""
+    create_index(engine, "ix_wishlist_customer_id", "wishlist", "customer_id")
+    create_index(engine, "ix_product_wishlist_id", "product", "wishlist_id")
+    create_index(engine, "ix_product_item_id", "product", "item_id")
+
+
+@migration(3, "Delete products with their wishlist using ON DELETE CASCADE")
+def cascade_product_deletes(engine):
+    """Recreates the product.wishlist_id foreign key with ON DELETE CASCADE"""
+    if product_deletes_cascade(engine):
+        return
+    if engine.dialect.name == "sqlite":
+        rebuild_sqlite_product_table(engine)
+        return
+    if engine.dialect.name != "postgresql":
+        logger.warning("Skipping ON DELETE CASCADE on %s, recreate the database to get it", engine.dialect.name)
+        return
+    for foreign_key in inspect(engine).get_foreign_keys("product"):
+        if foreign_key["constrained_columns"] != ["wishlist_id"]:
+            continue
+        name = foreign_key["name"]
+        with engine.begin() as connection:
+            # NOT VALID skips the full table check while the table is locked
+            connection.execute(text(
+                "ALTER TABLE product DROP CONSTRAINT {0}, "
+                "ADD CONSTRAINT {0} FOREIGN KEY (wishlist_id) REFERENCES wishlist (id) "
+                "ON DELETE CASCADE NOT VALID".format(name)
+            ))
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE product VALIDATE CONSTRAINT {}".format(name)))
+
+
+@migration(4, "Add wishlist.version for ETags and optimistic concurrency")
+def add_wishlist_version(engine):
+    """Adds the version column that is bumped by every change to a wishlist"""
+    columns = {column["name"] for column in inspect(engine).get_columns("wishlist")}
+    if "version" not in columns:
+        with engine.begin() as connection:
+            # a constant default does not rewrite the table on Postgres 11+
+            connection.execute(text("ALTER TABLE wishlist ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+@migration(5, "Index wishlist.name and product.name for search")
+def create_search_indexes(engine):
+    """Adds trigram indexes on Postgres and FTS5 tables on SQLite for the name searches"""
+    tables = schema_v1.sorted_tables
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as connection:
+            with connection.begin():
+                trigrams = enable_trigram_extension(connection)
+        if trigrams:
+            for target in tables:
+                create_index(engine, "ix_{}_name_trgm".format(target.name), target.name, "name gin_trgm_ops", using="gin")
+    elif engine.dialect.name == "sqlite":
+        with engine.begin() as connection:
+            for target in tables:
+                create_search_index(target, connection)
+                # indexes the rows that are already there
+                connection.execute(text("INSERT INTO {0}_search ({0}_search) VALUES ('rebuild')".format(target.name)))
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def create_index(engine, name, table, *columns, using=None):
+    """
+    Creates an index if it does not exist
+
+    On Postgres the index is built CONCURRENTLY so the table stays writable,
+    and an invalid index left behind by a failed concurrent build is
+    dropped and built again. using picks another kind of index than a
+    btree, on Postgres only.
+    """
+    column_list = ", ".join(columns)
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as connection:
+            connection.execute(text("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(name, table, column_list)))
+        return
+    # concurrent index builds can not run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        invalid = connection.execute(text(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+        ), name=name).scalar()
+        if invalid:
+            logger.warning("Dropping invalid index %s", name)
+            connection.execute(text("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name)))
+        logger.info("Creating index %s on %s (%s)", name, table, column_list)
+        connection.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {}{} ({})".format(
+            name, table, " USING {}".format(using) if using else "", column_list
+        )))
+
+
+def product_deletes_cascade(engine):
+    """Returns True if the foreign key of product.wishlist_id has ON DELETE CASCADE"""
+    if engine.dialect.name == "sqlite":
+        # the SQLite inspector of SQLAlchemy 1.3 does not report ON DELETE
+        with engine.connect() as connection:
+            rows = connection.execute(text("PRAGMA foreign_key_list(product)")).fetchall()
+        return any(row["from"] == "wishlist_id" and row["on_delete"].upper() == "CASCADE" for row in rows)
+    return any(
+        foreign_key["constrained_columns"] == ["wishlist_id"]
+        and (foreign_key["options"].get("ondelete") or "").upper() == "CASCADE"
+        for foreign_key in inspect(engine).get_foreign_keys("product")
+    )
+
+
+def rebuild_sqlite_product_table(engine):
+    """
+    Copies the products into a table with ON DELETE CASCADE on SQLite
+
+    These are the steps https://www.sqlite.org/lang_altertable.html gives
+    for changes ALTER TABLE can not make. The indexes and triggers of the
+    old table are created again on the new one.
+    """
+    logger.info("Rebuilding the product table with ON DELETE CASCADE")
+    with engine.connect() as connection:
+        # has no effect inside a transaction
+        connection.execute(text("PRAGMA foreign_keys = OFF"))
+        try:
+            with connection.begin():
+                statements = [row.sql for row in connection.execute(text(
+                    "SELECT sql FROM sqlite_master WHERE tbl_name = 'product' "
+                    "AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+                ))]
+                connection.execute(text(SQLITE_PRODUCT_V3))
+                connection.execute(text(
+                    "INSERT INTO product_new (id, wishlist_id, item_id, name, purchased) "
+                    "SELECT id, wishlist_id, item_id, name, purchased FROM product"
+                ))
+                connection.execute(text("DROP TABLE product"))
+                connection.execute(text("ALTER TABLE product_new RENAME TO product"))
+                for statement in statements:
+                    connection.execute(text(statement))
+                orphans = connection.execute(text("PRAGMA foreign_key_check(product)")).fetchall()
+                if orphans:
+                    raise RuntimeError("{} products belong to no wishlist, delete them first".format(len(orphans)))
+        finally:
+            connection.execute(text("PRAGMA foreign_keys = ON"))
+
+
+def applied_versions(engine):
+    """Returns the set of migration versions that have been applied"""
+    if not engine.has_table(schema_migrations.name):
+        return set()
+    with engine.connect() as connection:
+        return {row.version for row in connection.execute(schema_migrations.select())}
+
+
+def current_version(engine):
+    """Returns the highest applied migration version, 0 for an empty database"""
+    return max(applied_versions(engine), default=0)
+
+
+def upgrade(engine, target=None):
+    """
+    Applies the pending migrations in version order
+
+    Args:
+        engine: the engine of the database to migrate
+        target (integer): the last version to apply, defaults to all of them
+    Returns:
+        the list of versions that were applied
+    """
+    lock = None
+    if engine.dialect.name == "postgresql":
+        # keep two deploys from migrating at the same time
+        lock = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        lock.execute(text("SELECT pg_advisory_lock(:id)"), id=MIGRATION_LOCK_ID)
+    try:
+        metadata.create_all(engine)
+        done = applied_versions(engine)
+        applied = []
+        for version, description, function in sorted(MIGRATIONS, key=lambda item: item[0]):
+            if version in done or (target is not None and version > target):
+                continue
+            logger.info("Applying migration %s: %s", version, description)
+            function(engine)
+            with engine.begin() as connection:
+                connection.execute(schema_migrations.insert(), version=version, description=description)
+            applied.append(version)
+        return applied
+    finally:
+        if lock is not None:
+            lock.execute(text("SELECT pg_advisory_unlock(:id)"), id=MIGRATION_LOCK_ID)
+            lock.close()
+
+
+######################################################################
+#  C O M M A N D S
+######################################################################
+db_cli = AppGroup("db", help="Manages the database schema")
+
+
+@db_cli.command("upgrade")
+@click.option("--to", "target", type=int, default=None, help="The last version to apply")
+def upgrade_command(target):
+    """Applies the pending schema migrations"""
+    db.session.remove()
+    applied = upgrade(db.engine, target)
+    if applied:
+        click.echo("Applied migrations {}".format(", ".join(str(version) for version in applied)))
+    click.echo("Database is at version {}".format(current_version(db.engine)))
+
+
+@db_cli.command("current")
+def current_command():
+    """Shows the schema version of the database"""
+    version = current_version(db.engine)
+    latest = max(version for version, _, _ in MIGRATIONS)
+    click.echo("Database is at version {} of {}".format(version, latest))
@@ -20,19 +20,145 @@ products (list of string) - a list of products IDs, seperated by ';'
 """
 
 import logging
+import sqlite3
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, case, column, event, func, orm, select, table, text, tuple_
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from service.pool import InstrumentedQueuePool, QUEUE_POOL_OPTIONS
+from service.replica import RoutingSession
 logger = logging.getLogger("flask.app")
 
+class PooledSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy that instruments the connection pool and can read from a replica """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if sa_url.drivername.startswith("postgresql"):
+            # an address that drops packets would otherwise hang a connect until TCP gives up
+            options["connect_args"] = {"connect_timeout": app.config.get("DB_CONNECT_TIMEOUT", 5)}
+        return super().apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        if sa_url.drivername.startswith("sqlite"):
+            # SQLite does not use a QueuePool, so its options do not apply
+            for name in QUEUE_POOL_OPTIONS:
+                engine_opts.pop(name, None)
+        else:
+            engine_opts.setdefault("poolclass", InstrumentedQueuePool)
+        return super().create_engine(sa_url, engine_opts)
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = PooledSQLAlchemy()
+
+
+@event.listens_for(Engine, "connect")
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite only enforces foreign keys, and ON DELETE CASCADE, when asked to"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
 
 def init_db(app):
-    """Initialies the SQLAlchemy app"""
+    """Initialies the SQLAlchemy app and makes it the current app, for tests and scripts"""
     Wishlist.init_db(app)
 
 
+def _supports_returning():
+    """Returns True if the database can return rows from INSERT and UPDATE"""
+    return db.engine.dialect.name == "postgresql"
+
+
+def _insert_rows(table, rows):
+    """Inserts rows into a table and returns their new ids in the same order"""
+    if _supports_returning():
+        # Postgres does not promise that RETURNING gives the rows back in the
+        # order of VALUES, so the ids are taken from the sequence first and
+        # inserted with the rows by one multi-row INSERT ... VALUES
+        ids = sorted(row.id for row in db.session.execute(
+            text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) AS id FROM generate_series(1, :count)"),
+            {"table": table.name, "count": len(rows)}
+        ))
+        db.session.execute(table.insert().values([dict(row, id=row_id) for row, row_id in zip(rows, ids)]))
+        return ids
+    return [db.session.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+
+
+######################################################################
+#  N A M E   S E A R C H
+######################################################################
+# How well a name matches a search, best first
+SEARCH_MATCHES = ("exact", "prefix", "word", "substring")
+
+SQLITE_SEARCH_DDL = (
+    # an external content table: it only keeps the trigram index of the names
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {table}_search USING fts5("
+    "name, content='{table}', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {table}_search (rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {table}_search ({table}_search, rowid, name) VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF name ON {table} BEGIN "
+    "INSERT INTO {table}_search ({table}_search, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO {table}_search (rowid, name) VALUES (new.id, new.name); END",
+)
+
+
+def _escape_like(value):
+    """Escapes the wildcards of LIKE in value"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def enable_trigram_extension(connection):
+    """Installs pg_trgm if it can be, returns True if it is installed"""
+    available = connection.execute(text(
+        "SELECT installed_version FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).fetchone()
+    if available is None:
+        logger.warning("pg_trgm is not available, name searches will scan the tables")
+        return False
+    if available.installed_version is None:
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            savepoint.commit()
+        except DBAPIError as error:
+            savepoint.rollback()
+            logger.warning("pg_trgm could not be installed, name searches will scan the tables: %s", error)
+            return False
+    return True
+
+
+def create_search_index(target, connection, **kw):
+    """
+    Indexes the names of a new table for search
+
+    Postgres gets a trigram GIN index, when pg_trgm is available, that
+    ILIKE '%...%' can use. SQLite gets an FTS5 trigram table that triggers
+    keep up to date.
+    """
+    if connection.dialect.name == "postgresql":
+        if enable_trigram_extension(connection):
+            connection.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_{0}_name_trgm ON {0} USING gin (name gin_trgm_ops)".format(target.name)
+            ))
+    elif connection.dialect.name == "sqlite":
+        for statement in SQLITE_SEARCH_DDL:
+            connection.execute(text(statement.format(table=target.name)))
+
+
+def drop_search_index(target, connection, **kw):
+    """Drops the FTS5 table of a table that is dropped, the index and triggers go with it"""
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("DROP TABLE IF EXISTS {}_search".format(target.name)))
+
+
 class DataValidationError(Exception):
     """Used for a data validation errors when deserializing"""
     pass
@@ -65,13 +191,16 @@ class PersistentBase():
 
     @classmethod
     def init_db(cls, app):
-        """ Initializes the database session """
+        """ Initializes the database session and pushes an app context that is never popped """
         logger.info("Initializing database")
         cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
+        # This is where we initialize SQLAlchemy from the Flask app, unless it
+        # already was: Flask refuses to set an app up again once it has
+        # handled a request, and the engine follows SQLALCHEMY_DATABASE_URI
+        if "sqlalchemy" not in app.extensions:
+            db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        # the tables are created by the migrations in `flask db upgrade`
 
     @classmethod
     def all(cls):
@@ -91,6 +220,78 @@ class PersistentBase():
         logger.info("Processing lookup or 404 for id %s ...", by_id)
         return cls.query.get_or_404(by_id)
 
+    @classmethod
+    def exists(cls, by_id):
+        """ Returns True if there is a record with the given id """
+        logger.info("Processing exists check for id %s ...", by_id)
+        return db.session.query(cls.query.filter(cls.id == by_id).exists()).scalar()
+
+    @classmethod
+    def search(cls, words, limit, after=None):
+        """ Returns a page of the records whose name contains words, best matches first
+        Args:
+            words (string): the text to find in the names, in any case
+            limit (integer): the maximum number of records to return
+            after (tuple): only return records ranked after this (match, length, id)
+        Returns:
+            a list of (record, match) pairs, match is one of SEARCH_MATCHES,
+            and the position to pass as `after` to get the next page, which
+            is None when this is the last page
+        """
+        logger.info("Processing search of %s for %r", cls.__tablename__, words)
+        words = words.lower()
+        pattern = _escape_like(words)
+        name = func.lower(cls.name)
+        match = case([
+            (name == words, 0),
+            (name.like(pattern + "%", escape="\\"), 1),
+            (name.like("% " + pattern + "%", escape="\\"), 2),
+        ], else_=3)
+        # the shorter of two names that match as well is the closer match
+        length = func.length(cls.name)
+        query = db.session.query(cls, match, length)
+        if db.engine.dialect.name == "sqlite":
+            # the FTS5 table finds the rows, a phrase matches any substring of three or more characters
+            search = table(cls.__tablename__ + "_search", column("rowid"))
+            phrase = '"{}"'.format(words.replace('"', '""'))
+            query = query.filter(cls.id.in_(
+                select([search.c.rowid]).where(column(search.name).match(phrase))
+            ))
+        else:
+            # the trigram index, if there is one, finds the rows
+            query = query.filter(cls.name.ilike("%" + pattern + "%", escape="\\"))
+        if after is not None:
+            # a keyset on the sort order, so a deep page costs no more than the first
+            query = query.filter(tuple_(match, length, cls.id) > tuple_(*after))
+        # fetch one extra row to find out if there is another page
+        rows = query.order_by(match, length, cls.id).limit(limit + 1).all()
+        found = [(record, SEARCH_MATCHES[rank]) for record, rank, _ in rows[:limit]]
+        if len(rows) > limit:
+            record, rank, size = rows[limit - 1]
+            return found, (rank, size, record.id)
+        return found, None
+
+    @classmethod
+    def page(cls, limit, after=None, query=None):
+        """ Returns one page of records ordered by id
+        Args:
+            limit (integer): the maximum number of records to return
+            after (integer): only return records with an id greater than this
+            query: the query to page through, defaults to all of the records
+        Returns:
+            a tuple of the records and the id to pass as `after` to get
+            the next page, which is None when this is the last page
+        """
+        logger.info("Processing page of %s records after id %s", limit, after)
+        if query is None:
+            query = cls.query
+        if after is not None:
+            query = query.filter(cls.id > after)
+        # fetch one extra row to find out if there is another page
+        records = query.order_by(cls.id).limit(limit + 1).all()
+        if len(records) > limit:
+            return records[:limit], records[limit - 1].id
+        return records, None
 
 
 
@@ -105,14 +306,31 @@ class Product(db.Model, PersistentBase):
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     wishlist_id = db.Column(
-        db.Integer, db.ForeignKey('wishlist.id'), nullable=False)
-    item_id = db.Column(db.Integer)
+        db.Integer, db.ForeignKey('wishlist.id', ondelete='CASCADE'), nullable=False, index=True)
+    item_id = db.Column(db.Integer, index=True)
     name = db.Column(db.String(128))
     purchased = db.Column(db.Boolean, default=False)
 
     def __repr__(self):
         return "<Product %r id=[%s]>" % (self.name, self.id)
 
+    def create(self):
+        """
+        Creates a Product and bumps the version of its Wishlist
+        """
+        logger.info("Creating %s", self.name)
+        self.id = None  # id must be none to generate next primary key
+        db.session.add(self)
+        Wishlist.touch(self.wishlist_id)
+        db.session.commit()
+
+    def delete(self):
+        """ Removes a Product and bumps the version of its Wishlist """
+        logger.info("Deleting %s", self.name)
+        Wishlist.touch(self.wishlist_id)
+        db.session.delete(self)
+        db.session.commit()
+
     def serialize(self):
         """ Serializes a Product into a dictionary """
         return {
@@ -130,10 +348,11 @@ class Product(db.Model, PersistentBase):
             data (dict): A dictionary containing the resource data
         """
         try:
-            self.wishlist_id = data["wishlist_id"]
             self.item_id = data["item_id"]
             self.name = data["name"]
-            self.purchased = data["purchased"]
+            # products nested in a new wishlist do not have a wishlist yet
+            self.wishlist_id = data.get("wishlist_id")
+            self.purchased = data.get("purchased", False)
         except KeyError as error:
             raise DataValidationError(
                 "Invalid Product: missing " + error.args[0])
@@ -143,6 +362,120 @@ class Product(db.Model, PersistentBase):
             )
         return self
 
+    @classmethod
+    def create_batch(cls, products):
+        """ Creates many Products in one transaction
+        Args:
+            products (list of Product): the deserialized Products to insert
+        Returns:
+            the ids of the new Products in the same order as products
+        """
+        logger.info("Creating batch of %s Products", len(products))
+        if not products:
+            return []
+        rows = [
+            {
+                "wishlist_id": product.wishlist_id,
+                "item_id": product.item_id,
+                "name": product.name,
+                "purchased": bool(product.purchased)
+            }
+            for product in products
+        ]
+        try:
+            ids = _insert_rows(cls.__table__, rows)
+            Wishlist.touch(*{product.wishlist_id for product in products})
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
+
+    @classmethod
+    def find_ids_in_wishlist(cls, wishlist_id, ids):
+        """ Returns the set of ids that belong to Products in the Wishlist """
+        logger.info("Processing lookup for %s Products in Wishlist %s", len(ids), wishlist_id)
+        rows = db.session.query(cls.id).filter(cls.wishlist_id == wishlist_id, cls.id.in_(ids))
+        return {row.id for row in rows}
+
+    @classmethod
+    def count_by_wishlist(cls, wishlist_ids):
+        """ Returns the number of Products and purchased Products of each Wishlist
+        The totals are computed by the database with one GROUP BY query
+        Args:
+            wishlist_ids (list): the ids of the Wishlists to count
+        Returns:
+            a dictionary of {"items": n, "purchased": m} keyed by Wishlist id,
+            Wishlists without Products are left out
+        """
+        logger.info("Processing product counts for %s Wishlists", len(wishlist_ids))
+        rows = db.session.query(
+            cls.wishlist_id,
+            func.count(cls.id),
+            func.count(case([(cls.purchased.is_(True), cls.id)]))
+        ).filter(cls.wishlist_id.in_(wishlist_ids)).group_by(cls.wishlist_id)
+        return {wishlist_id: {"items": items, "purchased": purchased} for wishlist_id, items, purchased in rows}
+
+    @classmethod
+    def purchase(cls, wishlist_id, by_id):
+        """ Marks a Product in a Wishlist purchased if it is still available
+        Args:
+            wishlist_id (integer): the Wishlist the Product belongs to
+            by_id (integer): the id of the Product to purchase
+        Returns:
+            the purchased Product serialized into a dictionary, or None
+            if it does not exist or somebody else already purchased it
+        """
+        purchased = cls.purchase_many(wishlist_id, [by_id])
+        return purchased[0] if purchased else None
+
+    @classmethod
+    def purchase_many(cls, wishlist_id, ids):
+        """ Marks the available Products in a Wishlist purchased
+        The availability check is part of the UPDATE itself, so concurrent
+        purchases of the same Product can not both succeed and no row
+        locks are held while Python code runs
+        Args:
+            wishlist_id (integer): the Wishlist the Products belong to
+            ids (list of integer): the ids of the Products to purchase
+        Returns:
+            the Products this call purchased serialized into dictionaries
+        """
+        logger.info("Purchasing %s Products from Wishlist %s", len(ids), wishlist_id)
+        if not ids:
+            return []
+        table = cls.__table__
+        in_wishlist = table.c.wishlist_id == wishlist_id
+        available = table.c.purchased.isnot(True)
+        try:
+            if _supports_returning():
+                # a single UPDATE ... WHERE purchased IS NOT true RETURNING *
+                result = db.session.execute(
+                    table.update().where(in_wishlist & table.c.id.in_(ids) & available)
+                    .values(purchased=True).returning(*table.c)
+                )
+                rows = result.fetchall()
+            else:
+                # without RETURNING the row count of each conditional UPDATE
+                # tells us which of the Products this call purchased
+                update = table.update().where(in_wishlist & (table.c.id == bindparam("product_id")) & available)
+                purchased_ids = [
+                    product_id for product_id in dict.fromkeys(ids)
+                    if db.session.execute(update.values(purchased=True), {"product_id": product_id}).rowcount
+                ]
+                rows = []
+                if purchased_ids:
+                    rows = db.session.execute(
+                        table.select().where(table.c.id.in_(purchased_ids)).order_by(table.c.id)
+                    ).fetchall()
+            if rows:
+                Wishlist.touch(wishlist_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return [dict(row) for row in rows]
+
 
 ######################################################################
 #  W I S H L I S T   M O D E L
@@ -156,9 +489,18 @@ class Wishlist(db.Model, PersistentBase):
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer)
+    customer_id = db.Column(db.Integer, index=True)
     name = db.Column(db.String(128))
-    products = db.relationship('Product', backref='wishlist', lazy=True)
+    # bumped by every change to the wishlist or its products, it is used
+    # for ETags and makes an UPDATE fail if somebody else changed the row
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    # products are loaded for a whole batch of wishlists with one extra
+    # SELECT ... WHERE wishlist_id IN (...) instead of one query per wishlist
+    # and are deleted with their wishlist by the database's ON DELETE CASCADE
+    products = db.relationship('Product', backref='wishlist', lazy='selectin', order_by='Product.id',
+                               cascade='all', passive_deletes=True)
+
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return "<Wishlist %r id=[%s] customer=[%s]>" % (self.name, self.id, self.customer_id)
@@ -201,9 +543,142 @@ class Wishlist(db.Model, PersistentBase):
         return self
 
     def delete(self):
-        for product in self.products:
-            product.delete()
-        super(self.__class__, self).delete()
+        """ Removes a Wishlist, the database removes its Products with it """
+        logger.info("Deleting %s", self.name)
+        Wishlist.query.filter(Wishlist.id == self.id).delete()
+        db.session.commit()
+
+    @classmethod
+    def touch(cls, *wishlist_ids):
+        """ Bumps the version of Wishlists whose Products changed
+        This does not commit, it is part of the transaction that changed them
+        """
+        wishlist_ids = [wishlist_id for wishlist_id in wishlist_ids if wishlist_id is not None]
+        if wishlist_ids:
+            table = cls.__table__
+            db.session.execute(
+                table.update().where(table.c.id.in_(wishlist_ids)).values(version=table.c.version + 1)
+            )
+
+    @classmethod
+    def delete_by_customer(cls, customer_id):
+        """ Removes every Wishlist of a customer, and their Products, in one transaction
+        Args:
+            customer_id (integer): the customer whose Wishlists are deleted
+        Returns:
+            the ids of the deleted Wishlists
+        """
+        logger.info("Deleting Wishlists for customer: %s", customer_id)
+        table = cls.__table__
+        delete = table.delete().where(table.c.customer_id == customer_id)
+        try:
+            if _supports_returning():
+                ids = [row.id for row in db.session.execute(delete.returning(table.c.id))]
+            else:
+                ids = [row.id for row in db.session.query(cls.id).filter(cls.customer_id == customer_id)]
+                db.session.execute(delete)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
+
+    @classmethod
+    def create_batch(cls, wishlists):
+        """ Creates many Wishlists and their Products in one transaction
+        Args:
+            wishlists (list of Wishlist): the deserialized Wishlists to insert
+        Returns:
+            the ids of the new Wishlists in the same order as wishlists
+        """
+        logger.info("Creating batch of %s Wishlists", len(wishlists))
+        if not wishlists:
+            return []
+        table = cls.__table__
+        rows = [{"name": wishlist.name, "customer_id": wishlist.customer_id} for wishlist in wishlists]
+        try:
+            ids = _insert_rows(table, rows)
+            products = [
+                {
+                    "wishlist_id": wishlist_id,
+                    "item_id": product.item_id,
+                    "name": product.name,
+                    "purchased": bool(product.purchased)
+                }
+                for wishlist_id, wishlist in zip(ids, wishlists)
+                for product in wishlist.products
+            ]
+            if products:
+                # a list of parameters is sent as a single executemany
+                db.session.execute(Product.__table__.insert(), products)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
+
+    @classmethod
+    def export(cls, chunk_size=1000):
+        """ Yields every Wishlist serialized with its Products
+        Wishlists are streamed through a server side cursor chunk_size rows
+        at a time and the Products of each chunk are loaded with one query,
+        so memory use does not grow with the size of the table
+        Args:
+            chunk_size (integer): the number of Wishlists to fetch at a time
+        """
+        logger.info("Processing export in chunks of %s", chunk_size)
+        rows = cls.with_columns().order_by(cls.id).yield_per(chunk_size)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield from cls.serialize_rows(chunk)
+                chunk = []
+        if chunk:
+            yield from cls.serialize_rows(chunk)
+
+    @classmethod
+    def with_columns(cls, query=None):
+        """ Returns a query for the rows used by serialize_rows instead of objects
+        Args:
+            query: the Wishlist query to select from, defaults to all of them
+        """
+        if query is None:
+            query = cls.query
+        return query.with_entities(cls.id, cls.name, cls.customer_id, cls.version)
+
+    @classmethod
+    def serialize_rows(cls, chunk, embed="products"):
+        """ Serializes Wishlist rows with one query for their Products
+        This builds the same dictionaries as serialize() without loading any
+        objects, which is much faster for many Wishlists
+        Args:
+            chunk (list): rows from a with_columns() query
+            embed (string): "products" to add the Products, "counts" to add
+                their totals instead, "none" to leave them out
+        """
+        wishlists = {}
+        for row in chunk:
+            wishlists[row.id] = {
+                "id": row.id,
+                "name": row.name,
+                "customer_id": row.customer_id
+            }
+        if not wishlists or embed == "none":
+            return list(wishlists.values())
+        if embed == "counts":
+            counts = Product.count_by_wishlist(list(wishlists))
+            for wishlist_id, wishlist in wishlists.items():
+                wishlist["counts"] = counts.get(wishlist_id, {"items": 0, "purchased": 0})
+            return list(wishlists.values())
+        for wishlist in wishlists.values():
+            wishlist["products"] = []
+        products = db.session.query(
+            Product.id, Product.wishlist_id, Product.item_id, Product.name, Product.purchased
+        ).filter(Product.wishlist_id.in_(list(wishlists))).order_by(Product.id)
+        for product in products:
+            wishlists[product.wishlist_id]["products"].append(product._asdict())
+        return list(wishlists.values())
 
     @classmethod
     def find_by_name(cls, name):
@@ -231,4 +706,10 @@ class Wishlist(db.Model, PersistentBase):
     #         if int(field) >= 0: 
     #             return True
     #     else:
-    #          return False
\ No newline at end of file
+    #          return False
+
+
+# The names of both tables can be searched, however the tables are created
+for _table in (Wishlist.__table__, Product.__table__):
+    event.listen(_table, "after_create", create_search_index)
+    event.listen(_table, "before_drop", drop_search_index)
@@ -0,0 +1,152 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Module: pool
+
+Instrumented database connection pool
+
+InstrumentedQueuePool is a QueuePool that times how long each checkout
+waits for a connection and counts the connections it recycles because
+they reached pool_recycle. Pool events count the connections that are
+created and invalidated. The counters live in pool_stats so they
+survive the pool being recreated by engine.dispose().
+"""
+import time
+import logging
+import threading
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("flask.app")
+
+# Options of create_engine() that only a QueuePool understands
+QUEUE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+
+class PoolStats():
+    """ Counters for the connection pools of this process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Sets every counter back to zero """
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.created = 0
+            self.recycled = 0
+            self.invalidated = 0
+
+    def record_checkout(self, seconds, timed_out=False):
+        """ Counts a checkout and how long it waited for a connection """
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def record_connect(self):
+        """ Counts a new connection """
+        with self._lock:
+            self.created += 1
+
+    def record_recycle(self):
+        """ Counts a connection that is replaced because it reached pool_recycle """
+        with self._lock:
+            self.recycled += 1
+
+    def record_invalidate(self):
+        """ Counts a connection that was thrown away because it was broken """
+        with self._lock:
+            self.invalidated += 1
+
+    def as_dict(self):
+        """ Returns the counters """
+        with self._lock:
+            attempts = self.checkouts + self.timeouts
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.wait_seconds, 6),
+                "wait_seconds_avg": round(self.wait_seconds / attempts, 6) if attempts else 0.0,
+                "wait_seconds_max": round(self.max_wait_seconds, 6),
+                "connections_created": self.created,
+                "connections_recycled": self.recycled,
+                "connections_invalidated": self.invalidated,
+            }
+
+
+# The counters of every InstrumentedQueuePool in this process
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that times how long each checkout waits for a connection """
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, timeout=30, **kw):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, timeout=timeout, **kw)
+        # the settings create_engine() passed, QueuePool only keeps them in private attributes
+        self.max_overflow = max_overflow
+        self.recycle = kw.get("recycle", -1)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except exc.TimeoutError:
+            waited = time.perf_counter() - started
+            pool_stats.record_checkout(waited, timed_out=True)
+            logger.warning("No database connection was free after %.3fs: %s", waited, self.status())
+            raise
+        pool_stats.record_checkout(time.perf_counter() - started)
+        # the same test the record makes right after this, before it reconnects
+        if self.recycle > -1 and record.connection is not None and time.time() - record.starttime > self.recycle:
+            pool_stats.record_recycle()
+        return record
+
+
+@event.listens_for(InstrumentedQueuePool, "connect")
+def _count_connect(dbapi_connection, connection_record):
+    """ Counts new connections, the first ones and the ones that replace old ones """
+    pool_stats.record_connect()
+
+
+@event.listens_for(InstrumentedQueuePool, "invalidate")
+def _count_invalidate(dbapi_connection, connection_record, exception):
+    """ Counts connections that were found to be broken """
+    pool_stats.record_invalidate()
+
+
+def pool_status(pool):
+    """ Returns the current state of a pool together with the counters """
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "max_overflow": getattr(pool, "max_overflow", None),
+            "timeout": pool.timeout(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            # the pool counts its overflow up from -size
+            "overflow": max(pool.overflow(), 0),
+        })
+    status.update(pool_stats.as_dict())
+    return status
@@ -0,0 +1,169 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Module: replica
+
+Read replica routing
+
+RoutingSession sends the queries of a request to the "replica" bind when
+the request set g.read_replica, and everything else, including every
+flush, to the primary database. ReplicaMonitor checks from a background
+thread that the replica answers and how far it lags behind the primary,
+so that reads fall back to the primary when it can not be trusted.
+Requests only read the result of the last check, they never wait for
+the replica to answer it.
+"""
+import os
+import time
+import logging
+import threading
+from flask import g, has_app_context
+from flask_sqlalchemy import SignallingSession, get_state
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger("flask.app")
+
+# Key of the replica in SQLALCHEMY_BINDS
+REPLICA_BIND = "replica"
+
+# Seconds the replica is behind the primary, 0 when it has replayed
+# everything it received or is not a standby at all
+POSTGRES_LAG_QUERY = text(
+    "SELECT CASE"
+    " WHEN NOT pg_is_in_recovery() THEN 0"
+    " WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+    " ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+    " END"
+)
+
+
+def replica_configured(app):
+    """ Returns True if the app has a read replica """
+    return REPLICA_BIND in (app.config.get("SQLALCHEMY_BINDS") or {})
+
+
+class RoutingSession(SignallingSession):
+    """ Session that reads from the replica when the request allows it """
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_app_context() and g.get("read_replica", False):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class ReplicaMonitor():
+    """ Health and replication lag of the replica, checked by a background thread """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 5.0
+        self.max_lag = 2.0
+        self.reset()
+        # a thread does not survive a fork, every gunicorn worker starts its own
+        os.register_at_fork(after_in_child=self.reset)
+
+    def init_app(self, app):
+        """ Reads the settings of the app """
+        self.app = app
+        self.interval = app.config.get("REPLICA_CHECK_INTERVAL", 5.0)
+        self.max_lag = app.config.get("REPLICA_MAX_LAG", 2.0)
+
+    def reset(self):
+        """ Forgets the thread and the last check """
+        self._lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.checked_at = None
+        self.healthy = False
+        self.lag = None
+        self.error = None
+        self.fallbacks = 0
+
+    def start(self):
+        """ Starts the background checks unless they already run in this process """
+        if self.thread is not None:
+            return
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="replica-check", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """ Stops the background checks """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.reset()
+
+    def run(self):
+        """ Checks the replica every interval until stopped """
+        while not self.stopping.is_set():
+            self.check()
+            self.stopping.wait(self.interval)
+
+    def engine(self):
+        """ Returns the engine of the replica """
+        return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+
+    def usable(self):
+        """
+        Returns True if reads can go to the replica
+
+        Only the result of the last check is read. Until the first check,
+        and when the last one is older than a few intervals because the
+        thread is stuck, reads go to the primary.
+        """
+        usable = (
+            self.healthy
+            and self.checked_at is not None
+            and time.monotonic() - self.checked_at < 3 * self.interval
+            and self.lag <= self.max_lag
+        )
+        if not usable:
+            self.fallbacks += 1
+        return usable
+
+    def check(self):
+        """ Asks the replica how far behind it is """
+        engine = self.engine()
+        try:
+            with engine.connect() as connection:
+                if engine.dialect.name == "postgresql":
+                    lag = float(connection.execute(POSTGRES_LAG_QUERY).scalar())
+                else:
+                    connection.execute(text("SELECT 1"))
+                    lag = 0.0
+        except SQLAlchemyError as error:
+            if self.healthy or self.checked_at is None:
+                logger.warning("Reading from the primary, the replica is down: %s", error)
+            self.healthy, self.lag, self.error = False, None, str(error)
+        else:
+            self.healthy, self.lag, self.error = True, lag, None
+        self.checked_at = time.monotonic()
+
+    def as_dict(self):
+        """ Returns the result of the last check """
+        return {
+            "healthy": self.healthy,
+            "lag_seconds": self.lag,
+            "checked_seconds_ago": None if self.checked_at is None else round(time.monotonic() - self.checked_at, 3),
+            "error": self.error,
+            "fallbacks": self.fallbacks,
+        }
+
+
+# The state of the replica seen by this process, set up by init_app()
+replica_monitor = ReplicaMonitor()
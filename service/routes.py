@@ -17,25 +17,62 @@ Wishlist Service
 
 Paths:
 ------
-GET /wishlists - Returns a list all of the Wishlists
+GET /health/live - Returns 200 while the process answers
+GET /health/ready - Returns 200 while the database answered the last background check
+GET /wishlists - Returns a page of the Wishlists (use limit/after to page)
+GET /wishlists?ids={id},{id} - Returns many Wishlists by id, in the order they are asked for
 GET /wishlists/{id} - Returns the wishlists with a given id number
 POST /wishlists - creates a new wishlists record in the database
+POST /wishlists/batch - creates many wishlists records in one transaction
 PUT /wishlists/{id} - updates a wishlists record in the database
 DELETE /wishlists/{id} - deletes a wishlists record in the database
+DELETE /wishlists?customer_id={customer_id} - deletes every wishlist of a customer
+GET /wishlists/export - Streams every Wishlist as newline delimited JSON
+GET /wishlists/search?q={text} - Finds Wishlists by name, best matches first (type=products for Products)
+POST /wishlists/{id}/items/batch - adds many items to a wishlist in one transaction
+PUT /wishlists/{id}/items/{item_id}/purchase - purchases an item if it is still available
+PUT /wishlists/{id}/items/purchase - purchases many items with one statement
+
+Reads of a Wishlist, its items and a page of Wishlists return an ETag and
+answer If-None-Match with 304_NOT_MODIFIED. PUT /wishlists/{id} honors
+If-Match and returns 412_PRECONDITION_FAILED when the Wishlist changed.
+
+GET /wishlists and GET /wishlists/{id} take ?fields=id,name,... to pick the
+fields that are returned and ?embed=products|counts|none to return the
+Products, only their totals or nothing about them. With ?fields= the
+products or counts it names are embedded, and an ?embed= that disagrees
+is a 400_BAD_REQUEST.
+
+When a replica is configured GET requests read from it, except for a
+client that changed something in the last REPLICA_STICKY_SECONDS, which
+the primary_until cookie tells us, or while the replica is down or lags.
 """
 
 import os
 import sys
+import json
+import time
+import base64
+import hashlib
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, g, jsonify, request, url_for, make_response, abort, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse, inputs
+from jsonschema import Draft4Validator
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm.exc import StaleDataError
 from . import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Product, Wishlist, DataValidationError
+from service.models import db, Product, Wishlist, DataValidationError
+from service.cache import cache
+from service.health import health
+from service.pool import pool_status
+from service.replica import replica_configured, replica_monitor
+from service.serializers import dumps, json_response
 
 # Import Flask application
 from . import app
@@ -52,6 +89,97 @@ def index():
     # return jsonify(name='Pet Demo REST API Service', version='1.0', url=url, data=data), status.HTTP_200_OK
 
 
+######################################################################
+# GET CACHE STATISTICS
+######################################################################
+@app.route("/stats/cache")
+def cache_stats():
+    """Returns the hit and miss counters of the Wishlist cache"""
+    return jsonify(cache.stats()), status.HTTP_200_OK
+
+
+######################################################################
+# GET CONNECTION POOL STATISTICS
+######################################################################
+@app.route("/stats/pool")
+def pool_stats():
+    """Returns the state of the database connection pool and its counters"""
+    return jsonify(pool_status(db.engine.pool)), status.HTTP_200_OK
+
+
+######################################################################
+# GET READ REPLICA STATUS
+######################################################################
+@app.route("/stats/replica")
+def replica_stats():
+    """Returns the health and lag of the read replica from its last check"""
+    data = replica_monitor.as_dict()
+    data["configured"] = replica_configured(app)
+    return jsonify(data), status.HTTP_200_OK
+
+
+######################################################################
+# LIVENESS AND READINESS PROBES
+######################################################################
+@app.route("/health/live")
+def live():
+    """Returns 200_OK as long as the process answers, without touching the database"""
+    return jsonify(status="OK"), status.HTTP_200_OK
+
+
+@app.route("/health/ready")
+def ready():
+    """Returns the result of the last background check of the database"""
+    # starts the checks in servers that do not run the gunicorn hooks
+    health.start()
+    code = status.HTTP_200_OK if health.is_ready() else status.HTTP_503_SERVICE_UNAVAILABLE
+    return jsonify(health.as_dict()), code
+
+
+######################################################################
+# READ REPLICA ROUTING
+######################################################################
+PRIMARY_UNTIL_COOKIE = "primary_until"
+READ_METHODS = ("GET", "HEAD")
+
+@app.before_request
+def route_reads():
+    """Lets the queries of a read go to the replica when it is safe to"""
+    if replica_configured(app):
+        # starts the checks in servers that do not run the gunicorn hooks
+        replica_monitor.start()
+    g.read_replica = (
+        request.method in READ_METHODS
+        and replica_configured(app)
+        and not reads_own_writes()
+        and replica_monitor.usable()
+    )
+
+@app.after_request
+def stick_to_primary(response):
+    """Sends a client that changed something to the primary for a while"""
+    if request.method not in READ_METHODS and response.status_code < 400 and replica_configured(app):
+        seconds = app.config["REPLICA_STICKY_SECONDS"]
+        response.set_cookie(PRIMARY_UNTIL_COOKIE, "{:.3f}".format(time.time() + seconds),
+                            max_age=seconds, httponly=True)
+    return response
+
+@app.teardown_request
+def release_replica(error):
+    """Drops what was read from the replica so that no later write sees it"""
+    if g.pop("read_replica", False):
+        db.session.remove()
+
+def reads_own_writes():
+    """Returns True if the client changed something recently"""
+    try:
+        until = float(request.cookies.get(PRIMARY_UNTIL_COOKIE, 0))
+    except ValueError:
+        return False
+    now = time.time()
+    return now < until <= now + app.config["REPLICA_STICKY_SECONDS"]
+
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -99,12 +227,92 @@ wishlist_model = api.inherit(
     }
 )
 
-wishlist_args = reqparse.RequestParser()
+counts_model = api.model('ProductCounts', {
+    'items': fields.Integer(description='The number of Products in the Wishlist'),
+    'purchased': fields.Integer(description='The number of Products that were purchased')
+})
+
+# what the reads return, any field can be left out with ?fields= and ?embed=
+wishlist_view_model = api.inherit(
+    'WishlistViewModel',
+    wishlist_model,
+    {
+        'counts': fields.Nested(counts_model, description='The Product totals, returned with embed=counts'),
+        'missing': fields.Boolean(description='Only returned, as true, for ids asked for with ?ids= that do not exist')
+    }
+)
+
+batch_wishlist_model = api.inherit(
+    'BatchWishlistModel',
+    create_model,
+    {
+        'products': fields.List(fields.Nested(create_product_model), required=False)
+    }
+)
+
+batch_error_model = api.model('BatchError', {
+    'index': fields.Integer(description='The position of the Wishlist in the posted array'),
+    'message': fields.String(description='Why the Wishlist was not created')
+})
+
+batch_result_model = api.model('BatchResult', {
+    'ids': fields.List(fields.Integer, description='The new ids in posted order, null for Wishlists that were not created'),
+    'errors': fields.List(fields.Nested(batch_error_model))
+})
+
+purchase_request_model = api.model('PurchaseRequest', {
+    'ids': fields.List(fields.Integer, required=True, description='The ids of the Products to purchase')
+})
+
+purchase_result_model = api.model('PurchaseResult', {
+    'purchased': fields.List(fields.Nested(product_model), description='The Products this request purchased'),
+    'conflicts': fields.List(fields.Integer, description='The ids of Products that were already purchased'),
+    'not_found': fields.List(fields.Integer, description='The ids that are not Products in this Wishlist')
+})
+
+# The fields a client can pick with ?fields= and what ?embed= can add
+WISHLIST_FIELDS = ('id', 'name', 'customer_id', 'products', 'counts')
+EMBED_CHOICES = ('products', 'counts', 'none')
+
+view_args = reqparse.RequestParser()
+view_args.add_argument('fields', type=str, location="args", required=False,
+                       help='Comma separated fields to return, any of ' + ', '.join(WISHLIST_FIELDS))
+view_args.add_argument('embed', type=str, location="args", required=False, choices=EMBED_CHOICES,
+                       help='Embed the products (the default), their counts, or none of them')
+
+wishlist_args = view_args.copy()
 wishlist_args.add_argument('customer_id', type=int, location="args", required=False, help='List Wishlists by customer')
+wishlist_args.add_argument('limit', type=inputs.positive, location="args", required=False, help='The maximum number of Wishlists to return')
+wishlist_args.add_argument('after', type=str, location="args", required=False, help='The cursor from the next link of the previous page')
+wishlist_args.add_argument('ids', type=str, location="args", required=False, help='Comma separated ids of the Wishlists to return instead of a page')
+
+SEARCH_TYPES = ('wishlists', 'products')
+
+search_args = reqparse.RequestParser()
+search_args.add_argument('q', type=str, location="args", required=True, help='The text to find in the names, in any case')
+search_args.add_argument('type', type=str, location="args", required=False, default='wishlists', choices=SEARCH_TYPES,
+                         help='Search the names of the Wishlists or of the Products')
+search_args.add_argument('limit', type=inputs.positive, location="args", required=False, help='The maximum number of results to return')
+search_args.add_argument('after', type=str, location="args", required=False, help='The cursor from the next link of the previous page')
+
+delete_args = reqparse.RequestParser()
+delete_args.add_argument('customer_id', type=int, location="args", required=True, help='Delete the Wishlists of this customer')
 
 ######################################################################
 # Special Error Handlers
 ######################################################################
+@api.errorhandler(PoolTimeoutError)
+def database_busy(error):
+    """ Answers 503 right away when no database connection was free in time """
+    db.session.rollback()
+    message = 'No database connection is available, try again later'
+    app.logger.error('%s: %s', message, error)
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': message
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': str(app.config['DB_POOL_RETRY_AFTER'])}
+
 # @api.errorhandler(DataValidationError)
 # def request_validation_error(error):
 #     """ Handles Value Errors from bad data """
@@ -136,19 +344,26 @@ class WishlistResource(Resource):
     # RETRIEVE A WISHLIST
     #------------------------------------------------------------------
     @api.doc('get_wishlists')
+    @api.expect(view_args, validate=True)
+    @api.response(200, 'Success', wishlist_view_model)
+    @api.response(304, 'The Wishlist has not changed since the ETag in If-None-Match')
+    @api.response(400, 'Unknown field or embed')
     @api.response(404, 'Wishlist not found')
-    @api.marshal_with(wishlist_model)
     def get(self, wishlist_id):
         """
         Retrieve a single Wishlist
 
-        This endpoint will return a Wishlist based on it's id
+        This endpoint will return a Wishlist based on it's id. The Products
+        are not read from the database unless they are embedded.
         """
         app.logger.info("Request to Retrieve a wishlist with id [%s]", wishlist_id)
-        wishlist = Wishlist.find(wishlist_id)
-        if not wishlist:
-            abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
-        return wishlist.serialize(), status.HTTP_200_OK
+        wanted, embed = parse_view_args(view_args.parse_args())
+        entry = find_serialized_wishlist(wishlist_id, embed)
+        etag = wishlist_etag(wishlist_id, entry['version'])
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        wishlist = select_fields(entry['wishlist'], wanted)
+        return json_response(wishlist, status.HTTP_200_OK, {'ETag': quote_etag(etag)})
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING WISHLIST
@@ -157,30 +372,43 @@ class WishlistResource(Resource):
     @api.response(415, 'Unsupported media type')
     @api.response(404, 'Wishlist not found')
     @api.response(400, 'The posted Wishlist data was not valid')
+    @api.response(409, 'The Wishlist was changed by another request')
+    @api.response(412, 'The Wishlist does not match the ETag in If-Match')
     @api.expect(wishlist_model, validate=True)
     @api.marshal_with(wishlist_model)
     def put(self, wishlist_id):
         """
         Update a Wishlist
 
-        This endpoint will update a Wishlist based the body that is posted
+        This endpoint will update a Wishlist based the body that is posted.
+        Send the ETag of the Wishlist in If-Match to only update it if
+        nobody else changed it since it was read.
         """
         app.logger.info('Request to Update a wishlist with id [%s]', wishlist_id)
         check_content_type("application/json")
         wishlist = Wishlist.find(wishlist_id)
         if not wishlist:
             abort(status.HTTP_404_NOT_FOUND, "404 Not Found: Wishlist with id '{}' was not found.".format(wishlist_id))
-        app.logger.debug('Payload = %s', api.payload)
+        if request.if_match and not request.if_match.contains(wishlist_etag(wishlist_id, wishlist.version)):
+            abort(status.HTTP_412_PRECONDITION_FAILED, "Wishlist with id '{}' has changed.".format(wishlist_id))
+        log_payload()
         data = api.payload
         updated_wishlist = Wishlist()
         updated_wishlist.deserialize(data)
         wishlist.name = updated_wishlist.name
         wishlist.customer_id = updated_wishlist.customer_id
         wishlist.id = wishlist_id
-        wishlist.save()
+        try:
+            # the UPDATE only matches the version that was read above
+            wishlist.save()
+        except StaleDataError:
+            db.session.rollback()
+            code = status.HTTP_412_PRECONDITION_FAILED if request.if_match else status.HTTP_409_CONFLICT
+            abort(code, "Wishlist with id '{}' was changed by another request.".format(wishlist_id))
 
         app.logger.info("Wishlist with ID [%s] updated.", wishlist.id)
-        return wishlist.serialize(), status.HTTP_200_OK
+        etag = wishlist_etag(wishlist_id, wishlist.version)
+        return wishlist.serialize(), status.HTTP_200_OK, {'ETag': quote_etag(etag)}
 
     #------------------------------------------------------------------
     # DELETE A WISHLIST
@@ -212,26 +440,78 @@ class WishlistCollection(Resource):
     #------------------------------------------------------------------
     @api.doc('list_wishlists')
     @api.expect(wishlist_args, validate=True)
-    @api.marshal_list_with(wishlist_model)
+    @api.response(200, 'Success', [wishlist_view_model])
+    @api.response(304, 'The page has not changed since the ETag in If-None-Match')
+    @api.response(400, 'Unknown field or embed')
     def get(self):
-        """ Returns all of the Wishlists """
+        """
+        Returns a page of the Wishlists
+
+        Wishlists are ordered by id. When there are more results the
+        response carries a Link header with the URL of the next page.
+        The ETag of the page changes when any Wishlist on it changes.
+
+        With ?ids=1,2,3 the Wishlists with those ids are returned instead,
+        in the same order, and ids that do not exist are returned as
+        {"id": 3, "missing": true}.
+        """
         app.logger.info('Request to list Wishlists...')
-        wishlists = []
         args = wishlist_args.parse_args()
+        wanted, embed = parse_view_args(args)
+        if args['ids'] is not None:
+            return lookup_wishlists(args, wanted, embed)
+        limit = min(args['limit'] or app.config['DEFAULT_PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+        after = decode_cursor(args['after'])['id'] if args['after'] else None
+        query = None
         if args['customer_id']:
             app.logger.info('Filtering by customer: %s', args['customer_id'])
-            wishlists = Wishlist.find_by_customer(args['customer_id'])
+            query = Wishlist.find_by_customer(args['customer_id'])
         # elif args['name']:
         #     app.logger.info('Filtering by name: %s', args['name'])
         #     wishlists = Wishlist.find_by_name(args['name'])
         else:
             app.logger.info('Returning unfiltered list.')
-            wishlists = Wishlist.all()
-        results = [wishlist.serialize() for wishlist in wishlists]
+        # the rows are enough to tell if the page changed, the Products are
+        # only loaded when it has to be sent
+        rows, next_after = Wishlist.page(limit, after=after, query=Wishlist.with_columns(query))
+        etag = page_etag([(row.id, row.version) for row in rows], next_after)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        results = [select_fields(wishlist, wanted) for wishlist in Wishlist.serialize_rows(rows, embed)]
         app.logger.info('[%s] Wishlists returned', len(results))
-        return results, status.HTTP_200_OK
+        headers = {'ETag': quote_etag(etag)}
+        if next_after is not None:
+            params = {'limit': limit, 'after': encode_cursor({'id': next_after})}
+            for name in ('customer_id', 'fields'):
+                if args[name]:
+                    params[name] = args[name]
+            if args['embed']:
+                params['embed'] = args['embed']
+            next_url = api.url_for(WishlistCollection, _external=True, **params)
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        return json_response(results, status.HTTP_200_OK, headers)
 
 
+    #------------------------------------------------------------------
+    # DELETE ALL WISHLISTS OF A CUSTOMER
+    #------------------------------------------------------------------
+    @api.doc('delete_customer_wishlists')
+    @api.expect(delete_args, validate=True)
+    @api.response(204, 'Wishlists deleted')
+    @api.response(400, 'No customer_id was given')
+    def delete(self):
+        """
+        Delete all of the Wishlists of a customer
+
+        This endpoint deletes every Wishlist of the customer, and their
+        Products, in one transaction
+        """
+        args = delete_args.parse_args()
+        app.logger.info('Request to Delete the wishlists of customer [%s]', args['customer_id'])
+        ids = Wishlist.delete_by_customer(args['customer_id'])
+        app.logger.info('[%s] Wishlists of customer [%s] were deleted', len(ids), args['customer_id'])
+        return '', status.HTTP_204_NO_CONTENT
+
     #------------------------------------------------------------------
     # ADD A NEW WISHLIST
     #------------------------------------------------------------------
@@ -246,13 +526,150 @@ class WishlistCollection(Resource):
         """
         app.logger.info('Request to Create a Wishlist')
         wishlist = Wishlist()
-        app.logger.debug('Payload = %s', api.payload)
+        log_payload()
         wishlist.deserialize(api.payload)
         wishlist.create()
         app.logger.info('Wishlist with new id [%s] created!', wishlist.id)
         location_url = api.url_for(WishlistResource, wishlist_id=wishlist.id, _external=True)
         return wishlist.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
+######################################################################
+#  PATH: /wishlists/batch
+######################################################################
+@api.route('/wishlists/batch')
+class WishlistBatch(Resource):
+    """ Handles creating many Wishlists at once """
+    #------------------------------------------------------------------
+    # ADD MANY NEW WISHLISTS
+    #------------------------------------------------------------------
+    @api.doc('create_wishlists_batch')
+    @api.response(400, 'None of the posted Wishlists were valid')
+    @api.response(413, 'Too many Wishlists, or Products in all of them, in one batch')
+    @api.expect([batch_wishlist_model])
+    @api.marshal_with(batch_result_model, code=201)
+    def post(self):
+        """
+        Creates many Wishlists
+
+        This endpoint will create every valid Wishlist in the posted array,
+        with its Products, in one transaction. Invalid Wishlists are
+        reported by their position and do not stop the others.
+        """
+        app.logger.info('Request to Create a batch of Wishlists')
+        payload = api.payload
+        if not isinstance(payload, list):
+            abort(status.HTTP_400_BAD_REQUEST, 'The body must be an array of Wishlists')
+        if len(payload) > app.config['MAX_BATCH_SIZE']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  'A batch can have at most {} Wishlists'.format(app.config['MAX_BATCH_SIZE']))
+        # every Product of the batch is inserted in the same transaction
+        products = sum(len(data['products']) for data in payload
+                       if isinstance(data, dict) and isinstance(data.get('products'), list))
+        if products > app.config['MAX_BATCH_PRODUCTS']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  'A batch can have at most {} Products in all of its Wishlists'.format(app.config['MAX_BATCH_PRODUCTS']))
+        wishlists = []
+        positions = []
+        errors = []
+        for index, data in enumerate(payload):
+            messages = validation_errors(batch_wishlist_model, data)
+            if not messages:
+                try:
+                    wishlists.append(Wishlist().deserialize(data))
+                    positions.append(index)
+                    continue
+                except DataValidationError as error:
+                    messages = [str(error)]
+            errors.append({'index': index, 'message': '; '.join(messages)})
+        if not wishlists:
+            abort(status.HTTP_400_BAD_REQUEST, 'None of the {} Wishlists were valid'.format(len(payload)))
+        ids = [None] * len(payload)
+        for index, wishlist_id in zip(positions, Wishlist.create_batch(wishlists)):
+            ids[index] = wishlist_id
+        app.logger.info('[%s] Wishlists created, [%s] rejected', len(wishlists), len(errors))
+        return {'ids': ids, 'errors': errors}, status.HTTP_201_CREATED
+
+######################################################################
+#  PATH: /wishlists/search
+######################################################################
+@api.route('/wishlists/search')
+class WishlistSearch(Resource):
+    """ Finds Wishlists and Products by name """
+    #------------------------------------------------------------------
+    # SEARCH WISHLISTS OR PRODUCTS
+    #------------------------------------------------------------------
+    @api.doc('search_wishlists')
+    @api.expect(search_args, validate=True)
+    @api.response(400, 'The search text is too short or the cursor is invalid')
+    def get(self):
+        """
+        Search the names of the Wishlists or of their Products
+
+        Returns the Wishlists, or with ?type=products the Products, whose
+        name contains q in any case. Exact matches come first, then names
+        that start with q, then names with a word that starts with q, then
+        the rest, shorter names first. Each result says which of these
+        it is in "match". When there are more results the response
+        carries a Link header with the URL of the next page.
+        """
+        args = search_args.parse_args()
+        words = args['q'].strip()
+        app.logger.info('Request to search %s for %r', args['type'], words)
+        if len(words) < app.config['SEARCH_MIN_LENGTH']:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  'Search for at least {} characters'.format(app.config['SEARCH_MIN_LENGTH']))
+        limit = min(args['limit'] or app.config['DEFAULT_PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+        after = None
+        if args['after']:
+            position = decode_cursor(args['after'], 'match', 'length', 'id')
+            after = (position['match'], position['length'], position['id'])
+        if args['type'] == 'products':
+            matches, next_after = Product.search(words, limit, after)
+            results = [dict(product.serialize(), match=match) for product, match in matches]
+        else:
+            matches, next_after = Wishlist.search(words, limit, after)
+            results = [
+                {'id': wishlist.id, 'name': wishlist.name, 'customer_id': wishlist.customer_id, 'match': match}
+                for wishlist, match in matches
+            ]
+        app.logger.info('[%s] %s found', len(results), args['type'])
+        headers = {}
+        if next_after is not None:
+            match, length, last_id = next_after
+            params = {'q': words, 'type': args['type'], 'limit': limit,
+                      'after': encode_cursor({'match': match, 'length': length, 'id': last_id})}
+            next_url = api.url_for(WishlistSearch, _external=True, **params)
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        return json_response(results, status.HTTP_200_OK, headers)
+
+######################################################################
+#  PATH: /wishlists/export
+######################################################################
+@api.route('/wishlists/export')
+class WishlistExport(Resource):
+    """ Streams every Wishlist for bulk exports """
+    #------------------------------------------------------------------
+    # EXPORT ALL WISHLISTS
+    #------------------------------------------------------------------
+    @api.doc('export_wishlists')
+    @api.produces(['application/x-ndjson'])
+    @api.response(200, 'One Wishlist with its Products per line')
+    def get(self):
+        """
+        Export all of the Wishlists
+
+        This endpoint streams every Wishlist with its Products as newline
+        delimited JSON, ordered by id
+        """
+        app.logger.info('Request to export Wishlists...')
+        chunk_size = app.config['EXPORT_CHUNK_SIZE']
+
+        def generate():
+            for wishlist in Wishlist.export(chunk_size):
+                yield dumps(wishlist) + b"\n"
+
+        return Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype='application/x-ndjson')
+
 ######################################################################
 # RETRIEVE A WISHLIST
 ######################################################################
@@ -354,8 +771,9 @@ class ProductsCollections(Resource):
     def post(self,wishlist_id):
         # ADD A ITEM TO AN WISHLIST
         app.logger.info("Request to add an item to an wishlist")
-        wishlist = Wishlist.find_or_404(wishlist_id)
-        app.logger.info('Payload = %s', api.payload)
+        if not Wishlist.exists(wishlist_id):
+            abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+        log_payload()
 
         product = Product()
         api.payload['wishlist_id'] = wishlist_id
@@ -364,22 +782,70 @@ class ProductsCollections(Resource):
         # product.purchased = False
         product.create()
 
-        wishlist.products.append(product)
-        wishlist.save()
-       
         app.logger.info('product with new id [%s] created!', product.id)
         location_url = api.url_for(ProductsResource, wishlist_id =wishlist_id, item_id=product.id, _external=True)
 
         return product.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
     @api.doc('list_all_items')
-    @api.response(200, 'items listed')
+    @api.response(200, 'items listed', [product_model])
+    @api.response(304, 'The items have not changed since the ETag in If-None-Match')
+    @api.response(404, 'Wishlist not found')
     def get(self, wishlist_id):
         """Returns all of items of a wishlist"""
         app.logger.info("Request for Wishlist Products...")
-        wishlist = Wishlist.find_or_404(wishlist_id)
-        results = [product.serialize() for product in wishlist.products]
-        return results, status.HTTP_200_OK
+        entry = find_serialized_wishlist(wishlist_id)
+        etag = wishlist_etag(wishlist_id, entry['version'])
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        return json_response(entry['wishlist']['products'], status.HTTP_200_OK, {'ETag': quote_etag(etag)})
+######################################################################
+#  PATH: /wishlists/<wishlist_id>/items/batch
+######################################################################
+@api.route('/wishlists/<int:wishlist_id>/items/batch')
+@api.param('wishlist_id', 'The Wishlist identifier')
+class ProductsBatch(Resource):
+    """
+    ProductsBatch class
+    Handles adding many Products to a Wishlist at once
+    """
+    @api.doc('create_products_batch')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(404, 'Wishlist not found')
+    @api.response(413, 'Too many Products in one batch')
+    @api.expect([create_product_model], validate=True)
+    @api.marshal_list_with(product_model, code=201)
+    def post(self, wishlist_id):
+        """
+        Add many items to a Wishlist
+
+        This endpoint adds every Product in the posted array to the Wishlist
+        with a single commit. Nothing is added if any Product is invalid.
+        """
+        app.logger.info("Request to add a batch of items to wishlist [%s]", wishlist_id)
+        payload = api.payload
+        if not isinstance(payload, list):
+            abort(status.HTTP_400_BAD_REQUEST, 'The body must be an array of Products')
+        if len(payload) > app.config['MAX_BATCH_SIZE']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  'A batch can have at most {} Products'.format(app.config['MAX_BATCH_SIZE']))
+        if not Wishlist.exists(wishlist_id):
+            abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+        products = []
+        for data in payload:
+            product = Product()
+            try:
+                product.deserialize(data)
+            except DataValidationError as error:
+                abort(status.HTTP_400_BAD_REQUEST, str(error))
+            product.wishlist_id = wishlist_id
+            product.purchased = bool(product.purchased)
+            products.append(product)
+        for product, product_id in zip(products, Product.create_batch(products)):
+            product.id = product_id
+        app.logger.info('[%s] products added to wishlist [%s]', len(products), wishlist_id)
+        return [product.serialize() for product in products], status.HTTP_201_CREATED
+
 #@app.route('/wishlists/<int:wishlist_id>/items', methods=['GET'])
 #def list_items_wishlists(wishlist_id):
 #    """Returns all of items of a wishlist"""
@@ -487,15 +953,47 @@ class PurchaseResource(Resource):
     def put(self, wishlist_id, item_id):
         app.logger.info(
             "Request to purchase product with id: %s from wishlist with id: %s", item_id, wishlist_id)
-        product = Product.find(item_id)
+        product = Product.purchase(wishlist_id, item_id)
         if not product:
-            abort(status.HTTP_404_NOT_FOUND, 'Product with id [{}] was not found.'.format(item_id))
-        if product.purchased is True :
+            if not Product.find_ids_in_wishlist(wishlist_id, [item_id]):
+                abort(status.HTTP_404_NOT_FOUND, 'Product with id [{}] was not found.'.format(item_id))
             abort(status.HTTP_409_CONFLICT, 'Product with id [{}] is not available.'.format(item_id))
-        product.purchased = True
-        product.save()
         app.logger.info("Item [%s] with in Wishlist with ID [%s] purchased.",item_id, wishlist_id)
-        return product.serialize(), status.HTTP_200_OK
+        return product, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /wishlists/<wishlist_id>/items/purchase
+######################################################################
+@api.route('/wishlists/<int:wishlist_id>/items/purchase')
+@api.param('wishlist_id', 'The Wishlist identifier')
+class PurchaseCollection(Resource):
+    """
+    Purchase many Products
+    This endpoint purchases every available Product in one statement
+    """
+
+    @api.doc('purchase_products_batch')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(413, 'Too many Products in one batch')
+    @api.expect(purchase_request_model, validate=True)
+    @api.marshal_with(purchase_result_model)
+    def put(self, wishlist_id):
+        app.logger.info("Request to purchase a batch of products from wishlist with id: %s", wishlist_id)
+        ids = api.payload['ids']
+        if len(ids) > app.config['MAX_BATCH_SIZE']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  'A batch can have at most {} Products'.format(app.config['MAX_BATCH_SIZE']))
+        purchased = Product.purchase_many(wishlist_id, ids)
+        purchased_ids = {product['id'] for product in purchased}
+        missed = [item_id for item_id in dict.fromkeys(ids) if item_id not in purchased_ids]
+        existing = Product.find_ids_in_wishlist(wishlist_id, missed) if missed else set()
+        app.logger.info("[%s] items in Wishlist with ID [%s] purchased.", len(purchased), wishlist_id)
+        return {
+            'purchased': purchased,
+            'conflicts': [item_id for item_id in missed if item_id in existing],
+            'not_found': [item_id for item_id in missed if item_id not in existing]
+        }, status.HTTP_200_OK
 
 
 
@@ -504,6 +1002,11 @@ class PurchaseResource(Resource):
 ######################################################################
 
 
+def log_payload():
+    """Logs the body of the request when LOG_PAYLOADS is on, it may hold customer data"""
+    if app.config['LOG_PAYLOADS']:
+        app.logger.info('Payload = %s', api.payload)
+
 def check_content_type(media_type):
     """Checks that the media type is correct"""
     content_type = request.headers.get("Content-Type")
@@ -515,6 +1018,165 @@ def check_content_type(media_type):
         "Content-Type must be {}".format(media_type),
     )
 
+def find_serialized_wishlist(wishlist_id, embed='products'):
+    """
+    Returns the version and the serialized Wishlist from the cache or the database
+
+    The Wishlist row is always read first, by its primary key, and the
+    cache is asked for that version of it. If the version matches the
+    client's copy the Wishlist is not serialized at all and 'wishlist' is
+    None. Only Wishlists with their Products are cached, the counts are
+    always summed up by the database. Aborts with 404_NOT_FOUND if the
+    Wishlist does not exist.
+    """
+    row = Wishlist.with_columns(Wishlist.query.filter(Wishlist.id == wishlist_id)).first()
+    if row is None:
+        abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+    if request.if_none_match.contains_weak(wishlist_etag(wishlist_id, row.version)):
+        return {'version': row.version, 'wishlist': None}
+    if embed != 'products':
+        return {'version': row.version, 'wishlist': Wishlist.serialize_rows([row], embed)[0]}
+    key = wishlist_cache_key(wishlist_id, row.version)
+    wishlist = cache.get(key)
+    if wishlist is not None:
+        return {'version': row.version, 'wishlist': wishlist}
+    wishlist = Wishlist.serialize_rows([row])[0]
+    # what the replica returns may be older than a write the cache already saw
+    if not g.read_replica:
+        cache.set(key, wishlist)
+    return {'version': row.version, 'wishlist': wishlist}
+
+def find_serialized_wishlists(wishlist_ids, embed='products'):
+    """
+    Returns the cache entries of many Wishlists keyed by id
+
+    The versions of the Wishlists are read with one IN query, the ones
+    that are not cached in that version are serialized with one more for
+    their Products, or for their counts. Ids that do not exist are left out.
+    """
+    entries = {}
+    rows = Wishlist.with_columns(Wishlist.query.filter(Wishlist.id.in_(wishlist_ids))).all()
+    if embed != 'products':
+        missed = rows
+    else:
+        missed = []
+        for row in rows:
+            wishlist = cache.get(wishlist_cache_key(row.id, row.version))
+            if wishlist is None:
+                missed.append(row)
+            else:
+                entries[row.id] = {'version': row.version, 'wishlist': wishlist}
+    for row, wishlist in zip(missed, Wishlist.serialize_rows(missed, embed)):
+        entries[row.id] = {'version': row.version, 'wishlist': wishlist}
+        if embed == 'products' and not g.read_replica:
+            cache.set(wishlist_cache_key(row.id, row.version), wishlist)
+    return entries
+
+def lookup_wishlists(args, wanted, embed):
+    """Returns the response for GET /wishlists?ids=..."""
+    if args['customer_id'] or args['limit'] or args['after']:
+        abort(status.HTTP_400_BAD_REQUEST, 'ids can not be combined with customer_id, limit or after')
+    try:
+        # each id is returned once, where it was first asked for
+        wishlist_ids = list(dict.fromkeys(int(value) for value in args['ids'].split(',')))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "ids must be comma separated integers, not '{}'".format(args['ids']))
+    if len(wishlist_ids) > app.config['MAX_PAGE_SIZE']:
+        abort(status.HTTP_400_BAD_REQUEST, 'At most {} ids can be asked for at once'.format(app.config['MAX_PAGE_SIZE']))
+    app.logger.info('Looking up [%s] Wishlists by id', len(wishlist_ids))
+    entries = find_serialized_wishlists(wishlist_ids, embed)
+    versions = [(wishlist_id, entries[wishlist_id]['version'] if wishlist_id in entries else None)
+                for wishlist_id in wishlist_ids]
+    etag = page_etag(versions, None)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    results = [
+        select_fields(entries[wishlist_id]['wishlist'], wanted) if wishlist_id in entries
+        else {'id': wishlist_id, 'missing': True}
+        for wishlist_id in wishlist_ids
+    ]
+    app.logger.info('[%s] of [%s] Wishlists found', len(entries), len(wishlist_ids))
+    return json_response(results, status.HTTP_200_OK, {'ETag': quote_etag(etag)})
+
+def parse_view_args(args):
+    """
+    Returns the set of fields to return, None for all of them, and what to embed
+
+    When ?fields= is given it decides what is embedded: ?fields=id,name
+    does not load the Products and ?fields=id,counts returns the counts.
+    An ?embed= that asks for something else aborts with 400_BAD_REQUEST
+    rather than being dropped.
+    """
+    if not args['fields']:
+        return None, args['embed'] or 'products'
+    wanted = {name.strip() for name in args['fields'].split(',') if name.strip()}
+    unknown = wanted.difference(WISHLIST_FIELDS)
+    if unknown or not wanted:
+        abort(status.HTTP_400_BAD_REQUEST, "Unknown fields '{}', use any of {}".format(
+            ','.join(sorted(unknown)), ', '.join(WISHLIST_FIELDS)))
+    embedded = wanted.intersection(('products', 'counts'))
+    if len(embedded) > 1:
+        abort(status.HTTP_400_BAD_REQUEST, 'fields can hold products or counts, not both')
+    embed = embedded.pop() if embedded else 'none'
+    if args['embed'] and args['embed'] != embed:
+        abort(status.HTTP_400_BAD_REQUEST, "embed={} does not match fields={}".format(args['embed'], args['fields']))
+    return wanted, embed
+
+def select_fields(wishlist, wanted):
+    """Returns only the wanted fields of a serialized Wishlist"""
+    if wanted is None:
+        return wishlist
+    return {key: value for key, value in wishlist.items() if key in wanted}
+
+def wishlist_cache_key(wishlist_id, version):
+    """
+    Returns the cache key of a version of a Wishlist
+
+    Every write bumps the version, so nothing has to be removed from the
+    cache: an entry of an older version, whichever worker cached it and
+    however late a slow reader put it there, is never asked for again and
+    ages out.
+    """
+    return 'wishlist:{}:{}'.format(wishlist_id, version)
+
+def wishlist_etag(wishlist_id, version):
+    """Returns the strong ETag of a version of a Wishlist"""
+    return '{}-{}'.format(wishlist_id, version)
+
+def page_etag(versions, next_after):
+    """Returns the strong ETag of a page of Wishlists from their (id, version) pairs"""
+    digest = hashlib.sha1(str(next_after).encode("ascii"))
+    for wishlist_id, version in versions:
+        digest.update(';{}-{}'.format(wishlist_id, version).encode("ascii"))
+    return digest.hexdigest()
+
+def not_modified(etag):
+    """Returns a 304_NOT_MODIFIED response for a representation the client already has"""
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': quote_etag(etag)})
+
+def validation_errors(model, data):
+    """Returns the messages for everything in data that does not match the model"""
+    validator = Draft4Validator(model.__schema__, resolver=api.refresolver, format_checker=api.format_checker)
+    return [error.message for error in validator.iter_errors(data)]
+
+def encode_cursor(position):
+    """Encodes a page position as an opaque cursor"""
+    data = json.dumps(position, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, *keys):
+    """Decodes a cursor made by encode_cursor, whose keys, id by default, are ints, or aborts with 400_BAD_REQUEST"""
+    keys = keys or ("id",)
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        position = json.loads(data.decode("utf-8"))
+        if not isinstance(position, dict) or not all(
+                isinstance(position.get(key), int) and position[key] >= 0 for key in keys):
+            raise ValueError("cursor has no {}".format(", ".join(keys)))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid cursor '{}'".format(cursor))
+    return position
+
 def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     app.logger.error(message)
@@ -0,0 +1,50 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Module: serializers
+
+Fast path for JSON responses
+
+The read routes build their dictionaries straight from database rows in
+the shape of the Swagger models, so they do not need to be marshalled
+again. They are encoded with orjson when it is installed and with the
+standard json module otherwise.
+"""
+import json
+from flask import Response
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, it only makes encoding faster
+    orjson = None
+
+JSON_MIMETYPE = "application/json"
+
+
+def dumps(data):
+    """Encodes data as compact JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(data, code=200, headers=None):
+    """Returns a response with data encoded as JSON, skipping marshalling"""
+    return Response(dumps(data), status=code, headers=headers, mimetype=JSON_MIMETYPE)
+
+
+def encoder_name():
+    """Returns the name of the JSON encoder in use"""
+    return "orjson" if orjson is not None else "json"
@@ -0,0 +1,98 @@
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Module: tracing
+
+Slow query log and per request query budget
+
+Every SQL statement that takes longer than SLOW_QUERY_SECONDS is logged
+with its parameters, its duration and the route of the request that ran
+it. A request that runs more than QUERY_BUDGET statements is logged with
+the statement it repeated the most, which is how an N+1 query shows up.
+The log records carry the id of the request, which is also returned in
+the X-Request-ID header, see service/__init__.py.
+"""
+from collections import Counter
+from flask import g, has_request_context, request
+from flask_log_request_id import current_request_id
+from service.metrics import metrics
+
+
+def request_route():
+    """ Returns the method, path and route of the current request """
+    return "{} {} ({})".format(request.method, request.path, metrics.route(request.endpoint))
+
+
+class QueryTracer():
+    """ Logs slow SQL statements and requests that run too many of them """
+
+    def __init__(self):
+        self.logger = None
+        self.slow_query_seconds = 0.5
+        self.budget = 0
+
+    def init_app(self, app):
+        """ Traces the SQL statements of the requests of the app """
+        # the app logger has the handlers that add the request id
+        self.logger = app.logger
+        self.slow_query_seconds = app.config.get("SLOW_QUERY_SECONDS", 0.5)
+        self.budget = app.config.get("QUERY_BUDGET", 0)
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+        app.teardown_request(self.teardown_request)
+        # the metrics already time every statement
+        metrics.observe_statements(self.observe_statement)
+
+    def start_request(self):
+        """ Starts counting the statements of a request """
+        g.statements = Counter()
+
+    def end_request(self, response):
+        """ Logs the request if it ran more statements than the budget """
+        statements = g.get("statements")
+        if statements is not None and self.budget:
+            count = sum(statements.values())
+            if count > self.budget:
+                statement, repeated = statements.most_common(1)[0]
+                self.logger.warning(
+                    "Query budget exceeded by %s: %s statements, budget %s, %s times: %s",
+                    request_route(), count, self.budget, repeated, statement
+                )
+        request_id = current_request_id()
+        if request_id:
+            # lets the client quote the id of a request that went wrong
+            response.headers.setdefault("X-Request-ID", request_id)
+        return response
+
+    def teardown_request(self, error):
+        """ Stops counting the statements of a request """
+        g.pop("statements", None)
+
+    def observe_statement(self, statement, parameters, seconds):
+        """ Counts a statement for the request and logs it if it was slow """
+        in_request = has_request_context()
+        if in_request:
+            statements = g.get("statements")
+            if statements is not None:
+                statements[statement] += 1
+        if seconds >= self.slow_query_seconds:
+            self.logger.warning(
+                "Slow query %.3fs in %s: %s parameters %.500r",
+                seconds, request_route() if in_request else "no request", statement, parameters
+            )
+
+
+# The tracer of the service, set up by init_app()
+tracer = QueryTracer()
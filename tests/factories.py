@@ -2,11 +2,11 @@
 Test Factory to make fake objects for testing
 """
 import factory
-from factory.fuzzy import FuzzyChoice
+from factory.fuzzy import FuzzyChoice, FuzzyInteger
 from service.models import Wishlist, Product
-from random import randint
 
 products = ["lamp", "shirt", "ipad", "computer mouse", "milk", "scissors", "tomato"]
+wishlist_names = ["Christmas", "Baby Timmy", "Grandaddy Jo", "Hobby", "Books"]
 
 class ProductFactory(factory.Factory):
     """ Creates fake Addresses """
@@ -15,11 +15,9 @@ class ProductFactory(factory.Factory):
         model = Product
 
     id = factory.Sequence(lambda n: n)
-    # name = FuzzyChoice(choices=["lamp", "shirt", "ipad",
-                    #    "computer mouse", "milk", "scissors", "tomato"])
-
-    item_id = randint(1, len(products))
-    name = products[item_id-1]
+    # picked for every Product, not once when this module is imported
+    item_id = FuzzyInteger(1, len(products))
+    name = factory.LazyAttribute(lambda product: products[product.item_id - 1])
 
 
 class WishlistFactory(factory.Factory):
@@ -29,6 +27,5 @@ class WishlistFactory(factory.Factory):
         model = Wishlist
 
     id = factory.Sequence(lambda n: n)
-    name = FuzzyChoice(
-        choices=["Christmas", "Baby Timmy", "Grandaddy Jo", "Hobby", "Books"])
+    name = FuzzyChoice(choices=wishlist_names)
     customer_id = FuzzyChoice(choices=[1000, 2000])
@@ -0,0 +1,132 @@
+"""
+Test cases for the Wishlist cache
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+While debugging just these tests it's convinient to use this:
+    nosetests --stop tests/test_cache.py:TestCache
+"""
+
+import fnmatch
+import unittest
+from service.cache import Cache, LocalBackend, RedisBackend, NullBackend
+
+
+class FakeClock():
+    """ A clock that only moves when it is told to """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis():
+    """ Local stand-in for the parts of redis.Redis the cache uses """
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value.encode("utf-8")
+        self.ttls[key] = ttl
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [key for key in self.data if fnmatch.fnmatch(key, pattern)]
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+
+
+class TestCache(unittest.TestCase):
+    """ Test Cases for the cache backends """
+
+    def test_local_get_and_set(self):
+        """ Store and read back values """
+        backend = LocalBackend()
+        self.assertIsNone(backend.get("a"))
+        backend.set("a", {"id": 1})
+        self.assertEqual(backend.get("a"), {"id": 1})
+        backend.clear()
+        self.assertIsNone(backend.get("a"))
+
+    def test_local_lru_eviction(self):
+        """ The least recently used entry is evicted when the cache is full """
+        backend = LocalBackend(max_entries=2)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.get("a")
+        backend.set("c", 3)
+        self.assertEqual(len(backend), 2)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("a"), 1)
+        self.assertEqual(backend.get("c"), 3)
+
+    def test_local_ttl(self):
+        """ Entries expire after the time to live """
+        clock = FakeClock()
+        backend = LocalBackend(ttl=10, clock=clock)
+        backend.set("a", 1)
+        clock.now = 9
+        self.assertEqual(backend.get("a"), 1)
+        clock.now = 10
+        self.assertIsNone(backend.get("a"))
+        self.assertEqual(len(backend), 0)
+
+    def test_redis_backend(self):
+        """ The shared backend stores JSON with a time to live """
+        client = FakeRedis()
+        backend = RedisBackend(client, ttl=30, prefix="test:")
+        backend.set("a", {"id": 1, "products": []})
+        self.assertEqual(client.ttls["test:a"], 30)
+        self.assertEqual(backend.get("a"), {"id": 1, "products": []})
+        backend.set("b", {"id": 2})
+        client.data["other"] = b"kept"
+        backend.clear()
+        self.assertIsNone(backend.get("a"))
+        self.assertEqual(list(client.data), ["other"])
+
+    def test_null_backend(self):
+        """ The null backend never stores anything """
+        backend = NullBackend()
+        backend.set("a", 1)
+        backend.clear()
+        self.assertIsNone(backend.get("a"))
+
+    def test_hit_and_miss_counters(self):
+        """ The cache counts hits and misses """
+        cache = Cache(LocalBackend())
+        cache.get("a")
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("a")
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["entries"], 1)
+        cache.clear()
+        self.assertEqual(cache.stats()["hits"], 0)
+
+    def test_broken_backend(self):
+        """ A broken backend counts as a miss instead of failing """
+        class BrokenBackend(NullBackend):
+            def get(self, key):
+                raise ConnectionError("down")
+            def set(self, key, value):
+                raise ConnectionError("down")
+        cache = Cache(BrokenBackend())
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["misses"], 1)
@@ -0,0 +1,61 @@
+"""
+Test cases for the gunicorn concurrency profiles
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+While debugging just these tests it's convinient to use this:
+    nosetests --stop tests/test_gunicorn_conf.py:TestGunicornConf
+"""
+
+import os
+import importlib.util
+import multiprocessing
+import unittest
+from unittest.mock import patch
+
+CONF_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gunicorn.conf.py")
+
+
+def load_conf(**env):
+    """ Loads gunicorn.conf.py with the given environment """
+    spec = importlib.util.spec_from_file_location("gunicorn_conf", CONF_FILE)
+    conf = importlib.util.module_from_spec(spec)
+    with patch.dict(os.environ, env):
+        for name in ("GUNICORN_PROFILE", "GUNICORN_WORKERS", "GUNICORN_THREADS", "GUNICORN_PRELOAD"):
+            if name not in env:
+                os.environ.pop(name, None)
+        spec.loader.exec_module(conf)
+    return conf
+
+######################################################################
+#  G U N I C O R N   C O N F I G   T E S T   C A S E S
+######################################################################
+
+
+class TestGunicornConf(unittest.TestCase):
+    """ Test Cases for gunicorn.conf.py """
+
+    def test_default_profile(self):
+        """ One sync worker by default, preloaded """
+        conf = load_conf()
+        self.assertEqual((conf.workers, conf.threads, conf.worker_class), (1, 1, "sync"))
+        self.assertTrue(conf.preload_app)
+
+    def test_profiles(self):
+        """ The profiles are sized from the number of CPUs """
+        cpus = multiprocessing.cpu_count()
+        conf = load_conf(GUNICORN_PROFILE="sync")
+        self.assertEqual((conf.workers, conf.worker_class), (2 * cpus + 1, "sync"))
+        conf = load_conf(GUNICORN_PROFILE="threaded")
+        self.assertEqual((conf.workers, conf.threads, conf.worker_class), (cpus + 1, 4, "gthread"))
+
+    def test_overrides(self):
+        """ The sizes of a profile can be overridden """
+        conf = load_conf(GUNICORN_PROFILE="threaded", GUNICORN_WORKERS="3", GUNICORN_THREADS="1", GUNICORN_PRELOAD="false")
+        self.assertEqual((conf.workers, conf.threads, conf.worker_class), (3, 1, "sync"))
+        self.assertFalse(conf.preload_app)
+
+    def test_unknown_profile(self):
+        """ An unknown profile is an error """
+        self.assertRaises(ValueError, load_conf, GUNICORN_PROFILE="fast")
@@ -15,6 +15,7 @@ import os
 import logging
 import unittest
 from werkzeug.exceptions import NotFound
+from sqlalchemy.orm.exc import StaleDataError
 from service.models import Wishlist, DataValidationError, db, Product
 from service import app
 from .factories import WishlistFactory, ProductFactory
@@ -80,6 +81,10 @@ class TestWishlist(unittest.TestCase):
         self.assertEqual(product.id, None)
         return product
 
+    def _version(self, wishlist_id):
+        """ Reads the version of a wishlist the way the routes do """
+        return Wishlist.with_columns(Wishlist.query.filter(Wishlist.id == wishlist_id)).first().version
+
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
@@ -138,6 +143,25 @@ class TestWishlist(unittest.TestCase):
         wishlists = Wishlist.all()
         self.assertEqual(len(wishlists), 0)
 
+    def test_delete_wishlist_cascades(self):
+        """ Deleting a Wishlist deletes its Products """
+        wishlist = self._create_wishlist(products=[self._create_product(), self._create_product()])
+        wishlist.create()
+        self.assertEqual(len(Product.all()), 2)
+        wishlist.delete()
+        self.assertEqual(Wishlist.all(), [])
+        self.assertEqual(Product.all(), [])
+
+    def test_delete_by_customer(self):
+        """ Delete all of the Wishlists of a customer """
+        for customer_id in (1, 1, 2):
+            Wishlist(name="list", customer_id=customer_id, products=[self._create_product()]).create()
+        ids = Wishlist.delete_by_customer(1)
+        self.assertEqual(sorted(ids), [1, 2])
+        self.assertEqual([wishlist.customer_id for wishlist in Wishlist.all()], [2])
+        self.assertEqual(len(Product.all()), 1)
+        self.assertEqual(Wishlist.delete_by_customer(1), [])
+
     def test_find_or_404(self):
         """ Find or throw 404 error """
         wishlist = self._create_wishlist()
@@ -167,6 +191,84 @@ class TestWishlist(unittest.TestCase):
         self.assertEqual(same_wishlist.id, wishlist.id)
         self.assertEqual(same_wishlist.name, wishlist.name)
 
+    def test_exists(self):
+        """ Check if a Wishlist exists """
+        self.assertFalse(Wishlist.exists(1))
+        self._create_wishlist().create()
+        self.assertTrue(Wishlist.exists(1))
+
+    def test_page_wishlists(self):
+        """ Page through Wishlists by id """
+        for _ in range(5):
+            self._create_wishlist().create()
+        wishlists, after = Wishlist.page(2)
+        self.assertEqual([wishlist.id for wishlist in wishlists], [1, 2])
+        self.assertEqual(after, 2)
+        wishlists, after = Wishlist.page(2, after=after)
+        self.assertEqual([wishlist.id for wishlist in wishlists], [3, 4])
+        wishlists, after = Wishlist.page(2, after=after)
+        self.assertEqual([wishlist.id for wishlist in wishlists], [5])
+        self.assertIsNone(after)
+
+    def test_create_wishlist_batch(self):
+        """ Create a batch of Wishlists in one transaction """
+        self.assertEqual(Wishlist.create_batch([]), [])
+        wishlists = [
+            Wishlist().deserialize({"name": "first", "customer_id": 1, "products": [{"item_id": 1, "name": "lamp"}]}),
+            Wishlist().deserialize({"name": "second", "customer_id": 2}),
+        ]
+        ids = Wishlist.create_batch(wishlists)
+        self.assertEqual(len(ids), 2)
+        first = Wishlist.find(ids[0])
+        self.assertEqual(first.name, "first")
+        self.assertEqual(len(first.products), 1)
+        self.assertEqual(first.products[0].name, "lamp")
+        self.assertEqual(first.products[0].purchased, False)
+        second = Wishlist.find(ids[1])
+        self.assertEqual(second.name, "second")
+        self.assertEqual(second.products, [])
+        # each id belongs to the Wishlist at its position, and they ascend with it
+        names = ["list {}".format(number) for number in range(50)]
+        ids = Wishlist.create_batch([Wishlist().deserialize({"name": name, "customer_id": 3}) for name in names])
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual([Wishlist.find(wishlist_id).name for wishlist_id in ids], names)
+
+    def test_create_product_batch(self):
+        """ Create a batch of Products in one transaction """
+        self.assertEqual(Product.create_batch([]), [])
+        wishlist = self._create_wishlist(products=[])
+        wishlist.create()
+        products = [Product(wishlist_id=wishlist.id, item_id=n, name="item") for n in range(3)]
+        ids = Product.create_batch(products)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual([Product.find(product_id).item_id for product_id in ids], [0, 1, 2])
+
+    def test_purchase_products(self):
+        """ Purchase Products only while they are available """
+        wishlist = self._create_wishlist(products=[])
+        wishlist.create()
+        ids = Product.create_batch([Product(wishlist_id=wishlist.id, item_id=n, name="item") for n in range(3)])
+        product = Product.purchase(wishlist.id, ids[0])
+        self.assertEqual(product["id"], ids[0])
+        self.assertTrue(product["purchased"])
+        self.assertIsNone(Product.purchase(wishlist.id, ids[0]))
+        self.assertIsNone(Product.purchase(wishlist.id + 1, ids[1]))
+        purchased = Product.purchase_many(wishlist.id, ids)
+        self.assertEqual([product["id"] for product in purchased], ids[1:])
+        self.assertEqual(Product.purchase_many(wishlist.id, []), [])
+        self.assertEqual(Product.find_ids_in_wishlist(wishlist.id, ids + [0]), set(ids))
+
+    def test_export_wishlists(self):
+        """ Export Wishlists in chunks """
+        for _ in range(3):
+            wishlist = self._create_wishlist(products=[])
+            wishlist.products.append(self._create_product())
+            wishlist.create()
+        exported = list(Wishlist.export(chunk_size=2))
+        self.assertEqual(len(exported), 3)
+        for data in exported:
+            self.assertEqual(data, Wishlist.find(data["id"]).serialize())
+
     def test_serialize_a_wishlist(self):
         """ Serialize an wishlist """
         product = self._create_product()
@@ -288,6 +390,46 @@ class TestWishlist(unittest.TestCase):
         wishlist = Wishlist.find(wishlist.id)
         self.assertEqual(len(wishlist.products), 0)
 
+    def test_wishlist_version(self):
+        """ Changes to a wishlist or its products bump its version """
+        wishlist = self._create_wishlist()
+        wishlist.create()
+        self.assertEqual(self._version(wishlist.id), 1)
+        product = self._create_product()
+        product.wishlist_id = wishlist.id
+        product.create()
+        self.assertEqual(self._version(wishlist.id), 2)
+        Product.purchase_many(wishlist.id, [product.id])
+        self.assertEqual(self._version(wishlist.id), 3)
+        wishlist = Wishlist.find(wishlist.id)
+        wishlist.name = "renamed"
+        wishlist.save()
+        self.assertEqual(self._version(wishlist.id), 4)
+        Product.find(product.id).delete()
+        self.assertEqual(self._version(wishlist.id), 5)
+        self.assertIsNone(Wishlist.with_columns(Wishlist.query.filter(Wishlist.id == 0)).first())
+
+    def test_count_products(self):
+        """ Count the products of wishlists in the database """
+        first = self._create_wishlist(products=[self._create_product(), self._create_product()])
+        first.create()
+        second = self._create_wishlist()
+        second.create()
+        Product.purchase(first.id, first.products[0].id)
+        counts = Product.count_by_wishlist([first.id, second.id])
+        self.assertEqual(counts, {first.id: {"items": 2, "purchased": 1}})
+
+    def test_update_stale_wishlist(self):
+        """ Saving a wishlist that was changed since it was read fails """
+        wishlist = self._create_wishlist()
+        wishlist.create()
+        wishlist = Wishlist.find(wishlist.id)
+        # another request changes it after we read it
+        Wishlist.touch(wishlist.id)
+        wishlist.name = "renamed"
+        self.assertRaises(StaleDataError, wishlist.save)
+        db.session.rollback()
+
     # def test_correct_type_or_400(self):
     #     """ Correct or throw 400 error """
     #     wishlist = self._create_wishlist()
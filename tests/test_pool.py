@@ -0,0 +1,93 @@
+"""
+Test cases for the instrumented connection pool
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+While debugging just these tests it's convinient to use this:
+    nosetests --stop tests/test_pool.py:TestPool
+"""
+
+import time
+import sqlite3
+import unittest
+from sqlalchemy import exc
+from service.pool import InstrumentedQueuePool, pool_stats, pool_status
+
+######################################################################
+#  P O O L   T E S T   C A S E S
+######################################################################
+
+
+class TestPool(unittest.TestCase):
+    """ Test Cases for the instrumented connection pool """
+
+    def setUp(self):
+        """ This runs before each test """
+        pool_stats.reset()
+
+    def _pool(self, **options):
+        """ Returns a pool of in memory SQLite connections """
+        return InstrumentedQueuePool(lambda: sqlite3.connect(":memory:"), **options)
+
+    def test_checkouts(self):
+        """ Count checkouts and the connections they created """
+        pool = self._pool(pool_size=2, max_overflow=0)
+        first = pool.connect()
+        second = pool.connect()
+        status = pool_status(pool)
+        self.assertEqual(status["checked_out"], 2)
+        self.assertEqual(status["checkouts"], 2)
+        self.assertEqual(status["connections_created"], 2)
+        first.close()
+        second.close()
+        pool.connect().close()
+        status = pool_status(pool)
+        self.assertEqual(status["checked_out"], 0)
+        self.assertEqual(status["checked_in"], 2)
+        self.assertEqual(status["checkouts"], 3)
+        self.assertEqual(status["connections_created"], 2)
+
+    def test_overflow(self):
+        """ Report connections made over the size of the pool """
+        pool = self._pool(pool_size=1, max_overflow=1)
+        connections = [pool.connect(), pool.connect()]
+        status = pool_status(pool)
+        self.assertEqual(status["overflow"], 1)
+        self.assertEqual(status["max_overflow"], 1)
+        for connection in connections:
+            connection.close()
+
+    def test_timeout(self):
+        """ A checkout that can not get a connection in time is counted """
+        pool = self._pool(pool_size=1, max_overflow=0, timeout=0.05)
+        connection = pool.connect()
+        self.assertRaises(exc.TimeoutError, pool.connect)
+        status = pool_status(pool)
+        self.assertEqual(status["timeouts"], 1)
+        self.assertGreaterEqual(status["wait_seconds_max"], 0.05)
+        connection.close()
+
+    def test_recycle_and_invalidate(self):
+        """ Count connections that were replaced because of their age or because they broke """
+        pool = self._pool(pool_size=1, max_overflow=0, recycle=1)
+        pool.connect().close()
+        time.sleep(1.1)
+        pool.connect().close()
+        connection = pool.connect()
+        connection.invalidate()
+        connection.close()
+        status = pool_status(pool)
+        self.assertEqual(status["connections_invalidated"], 1)
+        self.assertEqual(status["connections_recycled"], 1)
+        # the invalidated connection is replaced on the next checkout, it is not recycled
+        pool.connect().close()
+        status = pool_status(pool)
+        self.assertEqual(status["connections_recycled"], 1)
+        self.assertEqual(status["connections_created"], 3)
+
+    def test_settings_survive_dispose(self):
+        """ The configured overflow and recycle are kept by a pool made by dispose() """
+        pool = self._pool(pool_size=1, max_overflow=3, recycle=60).recreate()
+        self.assertEqual(pool_status(pool)["max_overflow"], 3)
+        self.assertEqual(pool.recycle, 60)
@@ -11,14 +11,22 @@ Test cases can be run with the following:
 """
 
 import os
+import re
+import json
 import logging
 import unittest
+from contextlib import contextmanager
+from unittest.mock import patch
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
 # from unittest.mock import MagicMock, patch
 from urllib.parse import quote_plus
 from service import status  # HTTP Status Codes
 from service.models import db, init_db, Wishlist, DataValidationError, db, Product
-from service.routes import app
+from service.routes import app, wishlist_model, product_model, wishlist_cache_key
+from flask_restx import marshal
+from service.cache import cache
 from .factories import WishlistFactory, ProductFactory
 
 # Disable all but ciritcal errors during normal test run
@@ -58,6 +66,7 @@ class TestWishlistsServer(unittest.TestCase):
         """Runs before each test"""
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        cache.clear()
         self.app = app.test_client()
 
     def tearDown(self):
@@ -83,6 +92,30 @@ class TestWishlistsServer(unittest.TestCase):
             wishlists.append(test_wishlist)
         return wishlists
 
+    def _create_products(self, wishlist_id, count):
+        """Adds count products to a wishlist"""
+        for _ in range(count):
+            product = ProductFactory()
+            resp = self.app.post(
+                "/wishlists/{}/items".format(wishlist_id),
+                json=product.serialize(),
+                content_type=CONTENT_TYPE_JSON
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+    @contextmanager
+    def _count_queries(self):
+        """Counts the SQL statements run inside the with block"""
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = db.get_engine(app)
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
     def test_wishlist_repr(self):
         """Wishlist repr"""
         wishlist = WishlistFactory()
@@ -118,6 +151,96 @@ class TestWishlistsServer(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 5)
 
+    def test_get_wishlists_match_model(self):
+        """The fast serializer returns what the Swagger model documents"""
+        test_wishlist = self._create_wishlists(1)[0]
+        self._create_products(test_wishlist.id, 2)
+        for url in (BASE_URL, "/wishlists/{}".format(test_wishlist.id)):
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertEqual(data, json.loads(json.dumps(marshal(data, wishlist_model))))
+        resp = self.app.get("/wishlists/{}/items".format(test_wishlist.id))
+        data = resp.get_json()
+        self.assertEqual(data, json.loads(json.dumps(marshal(data, product_model))))
+
+    def test_get_wishlists_pages(self):
+        """Page through the Wishlists with the next link"""
+        wishlists = self._create_wishlists(5)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        ids = [wishlist["id"] for wishlist in resp.get_json()]
+        while "Link" in resp.headers:
+            next_url = re.match(r'<([^>]+)>; rel="next"', resp.headers["Link"]).group(1)
+            resp = self.app.get(next_url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertLessEqual(len(data), 2)
+            ids += [wishlist["id"] for wishlist in data]
+        self.assertEqual(ids, sorted(wishlist.id for wishlist in wishlists))
+
+    def test_get_wishlists_page_size_capped(self):
+        """The page size can not go over the server maximum"""
+        self._create_wishlists(3)
+        max_page_size = app.config["MAX_PAGE_SIZE"]
+        app.config["MAX_PAGE_SIZE"] = 2
+        try:
+            resp = self.app.get(BASE_URL, query_string="limit=100")
+        finally:
+            app.config["MAX_PAGE_SIZE"] = max_page_size
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn('rel="next"', resp.headers["Link"])
+
+    def test_get_wishlists_bad_cursor(self):
+        """Page with a cursor that was not made by the service"""
+        resp = self.app.get(BASE_URL, query_string="after=not-a-cursor")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_wishlists_query_count(self):
+        """Listing Wishlists does not run a query per Wishlist"""
+        query_counts = []
+        for count in (1, 6):
+            for _ in range(count):
+                resp = self.app.post(BASE_URL, json={"name": "list", "customer_id": 1000}, content_type=CONTENT_TYPE_JSON)
+                self._create_products(resp.get_json()["id"], 2)
+            with self._count_queries() as statements:
+                resp = self.app.get(BASE_URL)
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                resp = self.app.get(BASE_URL, query_string="customer_id=1000")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertTrue(all(len(wishlist["products"]) == 2 for wishlist in resp.get_json()))
+            query_counts.append(len(statements))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+# EXPORT
+    def test_export_wishlists(self):
+        """Export all of the Wishlists as newline delimited JSON"""
+        wishlists = self._create_wishlists(5)
+        for wishlist in wishlists:
+            self._create_products(wishlist.id, 2)
+        chunk_size = app.config["EXPORT_CHUNK_SIZE"]
+        app.config["EXPORT_CHUNK_SIZE"] = 2
+        try:
+            resp = self.app.get(f"{BASE_URL}/export")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            lines = resp.get_data(as_text=True).splitlines()
+        finally:
+            app.config["EXPORT_CHUNK_SIZE"] = chunk_size
+        data = [json.loads(line) for line in lines]
+        self.assertEqual([wishlist["id"] for wishlist in data], [wishlist.id for wishlist in wishlists])
+        for wishlist in data:
+            self.assertEqual(len(wishlist["products"]), 2)
+            for product in wishlist["products"]:
+                self.assertEqual(product["wishlist_id"], wishlist["id"])
+
+    def test_export_no_wishlists(self):
+        """Export when there are no Wishlists"""
+        resp = self.app.get(f"{BASE_URL}/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_data(as_text=True), "")
+
 # GET
     def test_get_wishlist(self):
         """Get a single Wishlist"""
@@ -131,11 +254,95 @@ class TestWishlistsServer(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(data["name"], wishlist.name)
 
+    def test_get_wishlist_query_count(self):
+        """Getting a Wishlist runs the same queries however many Products it has"""
+        query_counts = []
+        for count in (1, 10):
+            wishlist = self._create_wishlists(1)[0]
+            self._create_products(wishlist.id, count)
+            db.session.expire_all()
+            with self._count_queries() as statements:
+                resp = self.app.get(f"{BASE_URL}/{wishlist.id}")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(len(resp.get_json()["products"]), count)
+            query_counts.append(len(statements))
+        self.assertEqual(query_counts[0], query_counts[1])
+
     def test_get_wishlist_not_found(self):
         """Get a Wishlist thats not found"""
         resp = self.app.get("/wishlists/0")
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+# CACHE
+    def test_get_wishlist_cached(self):
+        """A repeat read of a Wishlist is served from the cache"""
+        wishlist = self._create_wishlists(1)[0]
+        resp = self.app.get(f"{BASE_URL}/{wishlist.id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        with self._count_queries() as statements:
+            cached = self.app.get(f"{BASE_URL}/{wishlist.id}")
+            items = self.app.get(f"{BASE_URL}/{wishlist.id}/items")
+        # each read only looks the version of the Wishlist up
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(all("product" not in statement for statement in statements))
+        self.assertEqual(cached.get_json(), resp.get_json())
+        self.assertEqual(items.get_json(), [])
+        resp = self.app.get("/stats/cache")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        stats = resp.get_json()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_cache_invalidated_by_writes(self):
+        """Every write to a Wishlist invalidates its cached copy"""
+        wishlist = self._create_wishlists(1)[0]
+        url = f"{BASE_URL}/{wishlist.id}"
+
+        def products():
+            return self.app.get(url).get_json()["products"]
+
+        self.assertEqual(products(), [])
+        resp = self.app.post(f"{url}/items", json={"item_id": 1, "name": "lamp"}, content_type=CONTENT_TYPE_JSON)
+        first_id = resp.get_json()["id"]
+        self.assertEqual([product["id"] for product in products()], [first_id])
+        resp = self.app.post(f"{url}/items/batch", json=[{"item_id": 2, "name": "milk"}], content_type=CONTENT_TYPE_JSON)
+        second_id = resp.get_json()[0]["id"]
+        self.assertEqual(len(products()), 2)
+        self.app.put(f"{url}/items/{first_id}/purchase", content_type=CONTENT_TYPE_JSON)
+        self.assertTrue(products()[0]["purchased"])
+        self.app.put(f"{url}/items/purchase", json={"ids": [second_id]}, content_type=CONTENT_TYPE_JSON)
+        self.assertTrue(products()[1]["purchased"])
+        self.app.delete(f"{url}/items/{first_id}")
+        self.assertEqual([product["id"] for product in products()], [second_id])
+        self.app.put(url, json={"name": "renamed", "customer_id": wishlist.customer_id}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(self.app.get(url).get_json()["name"], "renamed")
+        self.app.delete(url)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cache_follows_other_writers(self):
+        """A write this process did not see, or a stale entry put back after it, is never served"""
+        wishlist = self._create_wishlists(1)[0]
+        url = f"{BASE_URL}/{wishlist.id}"
+        old = self.app.get(url).get_json()
+        # another worker renames the Wishlist, this process's cache is not told
+        found = Wishlist.find(wishlist.id)
+        found.name = "renamed elsewhere"
+        found.save()
+        self.assertEqual(self.app.get(url).get_json()["name"], "renamed elsewhere")
+        # a slow reader puts the body it read before the write back
+        cache.set(wishlist_cache_key(wishlist.id, 1), old)
+        resp = self.app.get(url)
+        self.assertEqual(resp.get_json()["name"], "renamed elsewhere")
+        self.assertEqual(resp.headers["ETag"], '"{}-{}"'.format(wishlist.id, found.version))
+
+    def test_cache_invalidated_by_customer_delete(self):
+        """Deleting a Customer's Wishlists invalidates them"""
+        resp = self.app.post(BASE_URL, json={"name": "list", "customer_id": 5}, content_type=CONTENT_TYPE_JSON)
+        url = f"{BASE_URL}/{resp.get_json()['id']}"
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)
+        self.app.delete(BASE_URL, query_string="customer_id=5")
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
 # CREATE
     def test_create_wishlist(self):
         """Create a new Wishlist"""
@@ -196,6 +403,83 @@ class TestWishlistsServer(unittest.TestCase):
     #     )
     #     self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+# CREATE BATCH
+    def test_create_wishlist_batch(self):
+        """Create many Wishlists with their Products in one request"""
+        payload = []
+        for index in range(3):
+            wishlist = WishlistFactory().serialize()
+            wishlist["products"] = [{"item_id": index, "name": "item {}".format(index)}] * index
+            payload.append(wishlist)
+        resp = self.app.post(f"{BASE_URL}/batch", json=payload, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["errors"], [])
+        self.assertEqual(len(data["ids"]), 3)
+        for wishlist_id, posted in zip(data["ids"], payload):
+            resp = self.app.get(f"{BASE_URL}/{wishlist_id}")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            wishlist = resp.get_json()
+            self.assertEqual(wishlist["name"], posted["name"])
+            self.assertEqual(wishlist["customer_id"], posted["customer_id"])
+            self.assertEqual(len(wishlist["products"]), len(posted["products"]))
+            for product in wishlist["products"]:
+                self.assertEqual(product["wishlist_id"], wishlist_id)
+                self.assertFalse(product["purchased"])
+
+    def test_create_wishlist_batch_with_errors(self):
+        """Invalid Wishlists in a batch are reported without stopping the rest"""
+        payload = [
+            {"name": "good", "customer_id": 1},
+            {"name": "no customer"},
+            {"name": "bad customer", "customer_id": "one"},
+            {"name": "bad product", "customer_id": 1, "products": [{"name": "no item id"}]},
+            {"name": "also good", "customer_id": 2},
+        ]
+        resp = self.app.post(f"{BASE_URL}/batch", json=payload, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual([error["index"] for error in data["errors"]], [1, 2, 3])
+        self.assertIsNotNone(data["ids"][0])
+        self.assertEqual(data["ids"][1:4], [None, None, None])
+        self.assertIsNotNone(data["ids"][4])
+        resp = self.app.get(BASE_URL)
+        self.assertEqual([wishlist["name"] for wishlist in resp.get_json()], ["good", "also good"])
+
+    def test_create_wishlist_batch_all_invalid(self):
+        """A batch with no valid Wishlists is rejected"""
+        resp = self.app.post(f"{BASE_URL}/batch", json=[{}], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(f"{BASE_URL}/batch", json={"name": "x"}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_wishlist_batch_too_large(self):
+        """A batch can not be bigger than the server maximum"""
+        max_batch_size = app.config["MAX_BATCH_SIZE"]
+        app.config["MAX_BATCH_SIZE"] = 2
+        try:
+            payload = [{"name": "list", "customer_id": 1}] * 3
+            resp = self.app.post(f"{BASE_URL}/batch", json=payload, content_type=CONTENT_TYPE_JSON)
+        finally:
+            app.config["MAX_BATCH_SIZE"] = max_batch_size
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_create_wishlist_batch_too_many_products(self):
+        """The Products of all the Wishlists of a batch can not be more than the server maximum"""
+        max_batch_products = app.config["MAX_BATCH_PRODUCTS"]
+        app.config["MAX_BATCH_PRODUCTS"] = 3
+        products = [{"item_id": 1, "name": "item"}] * 2
+        try:
+            payload = [{"name": "list", "customer_id": 1, "products": products}] * 2
+            resp = self.app.post(f"{BASE_URL}/batch", json=payload, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            payload[1] = {"name": "list", "customer_id": 1, "products": products[:1]}
+            resp = self.app.post(f"{BASE_URL}/batch", json=payload, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        finally:
+            app.config["MAX_BATCH_PRODUCTS"] = max_batch_products
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 2)
+
 # UPDATE
     def test_update_wishlist(self):
         """Update an existing Wishlist"""
@@ -248,6 +532,40 @@ class TestWishlistsServer(unittest.TestCase):
     # )
     # self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_delete_wishlist_with_products(self):
+        """Delete a Wishlist and its Products with one statement"""
+        test_wishlist = self._create_wishlists(1)[0]
+        self._create_products(test_wishlist.id, 3)
+        resp = self.app.get(f"{BASE_URL}/{test_wishlist.id}/items")
+        product_ids = [product["id"] for product in resp.get_json()]
+        with self._count_queries() as statements:
+            resp = self.app.delete(f"{BASE_URL}/{test_wishlist.id}")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len([s for s in statements if s.startswith("DELETE")]), 1)
+        for product_id in product_ids:
+            resp = self.app.get(f"{BASE_URL}/{test_wishlist.id}/items/{product_id}")
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_delete_wishlists_by_customer(self):
+        """Delete every Wishlist of a Customer"""
+        for customer_id in (1, 1, 2):
+            resp = self.app.post(BASE_URL, json={"name": "list", "customer_id": customer_id}, content_type=CONTENT_TYPE_JSON)
+            self._create_products(resp.get_json()["id"], 2)
+        resp = self.app.delete(BASE_URL, query_string="customer_id=1")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get(BASE_URL)
+        data = resp.get_json()
+        self.assertEqual([wishlist["customer_id"] for wishlist in data], [2])
+        self.assertEqual(Product.query.count(), 2)
+
+    def test_delete_wishlists_without_customer(self):
+        """Deleting the Wishlist collection needs a customer"""
+        self._create_wishlists(1)
+        resp = self.app.delete(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 1)
+
 # QUERY
 
     def test_query_wishlist_list_by_customer(self):
@@ -267,6 +585,23 @@ class TestWishlistsServer(unittest.TestCase):
         for wishlist in data:
             self.assertEqual(wishlist["customer_id"], test_customer_id)
 
+    def test_query_wishlist_list_by_customer_pages(self):
+        """Page through the Wishlists of a Customer"""
+        for _ in range(3):
+            resp = self.app.post(BASE_URL, json={"name": "list", "customer_id": 7}, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self._create_wishlists(2)
+        resp = self.app.get(BASE_URL, query_string="customer_id=7&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        next_url = re.match(r'<([^>]+)>; rel="next"', resp.headers["Link"]).group(1)
+        self.assertIn("customer_id=7", next_url)
+        resp = self.app.get(next_url)
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["customer_id"], 7)
+        self.assertNotIn("Link", resp.headers)
+
     # @patch('service.routes.Pet.find_by_name')
     # def test_bad_request(self, bad_request_mock):
     #     """ Test a Bad Request error from Find By Name """
@@ -299,6 +634,74 @@ class TestWishlistsServer(unittest.TestCase):
         self.assertEqual(data["name"], product.name)
         self.assertEqual(data["wishlist_id"], test_wishlist.id)
 
+    def test_add_product_wishlist_not_found(self):
+        """ Add an item to a wishlist that does not exist """
+        resp = self.app.post(
+            "/wishlists/0/items",
+            json={"item_id": 1, "name": "lamp"},
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_add_product_single_commit(self):
+        """ Adding an item commits once """
+        test_wishlist = self._create_wishlists(1)[0]
+        with self._count_queries() as statements:
+            resp = self.app.post(
+                "/wishlists/{}/items".format(test_wishlist.id),
+                json={"item_id": 1, "name": "lamp"},
+                content_type="application/json"
+            )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len([s for s in statements if s.startswith("INSERT")]), 1)
+        # the only UPDATE bumps the version of the wishlist
+        updates = [s for s in statements if s.startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertTrue(updates[0].startswith("UPDATE wishlist SET version"))
+
+# ADD ITEMS TO WISHLIST IN A BATCH
+
+    def test_add_product_batch(self):
+        """ Add many items to a wishlist at once """
+        test_wishlist = self._create_wishlists(1)[0]
+        payload = [{"item_id": item_id, "name": "item {}".format(item_id)} for item_id in range(5)]
+        resp = self.app.post(
+            "/wishlists/{}/items/batch".format(test_wishlist.id),
+            json=payload,
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual([product["item_id"] for product in data], list(range(5)))
+        for product in data:
+            self.assertEqual(product["wishlist_id"], test_wishlist.id)
+            self.assertFalse(product["purchased"])
+        resp = self.app.get("/wishlists/{}/items".format(test_wishlist.id))
+        self.assertEqual(sorted(product["id"] for product in resp.get_json()),
+                         sorted(product["id"] for product in data))
+
+    def test_add_product_batch_invalid(self):
+        """ A batch with an invalid item adds nothing """
+        test_wishlist = self._create_wishlists(1)[0]
+        payload = [{"item_id": 1, "name": "lamp"}, {"name": "no item id"}]
+        resp = self.app.post(
+            "/wishlists/{}/items/batch".format(test_wishlist.id),
+            json=payload,
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/wishlists/{}/items".format(test_wishlist.id))
+        self.assertEqual(resp.get_json(), [])
+
+    def test_add_product_batch_not_found(self):
+        """ Add a batch of items to a wishlist that does not exist """
+        resp = self.app.post(
+            "/wishlists/0/items/batch",
+            json=[{"item_id": 1, "name": "lamp"}],
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
 # GET ITEM FROM WISHLIST
 
     def test_get_product(self):
@@ -390,6 +793,79 @@ class TestWishlistsServer(unittest.TestCase):
         
         self.assertEqual(purchased_product["purchased"], True, "products does not match")
 
+    def test_purchase_product_twice(self):
+        """ A product can only be purchased once """
+        test_wishlist = self._create_wishlists(1)[0]
+        resp = self.app.post(
+            "/wishlists/{}/items".format(test_wishlist.id),
+            json={"item_id": 1, "name": "lamp"},
+            content_type="application/json"
+        )
+        product_id = resp.get_json()["id"]
+        url = "/wishlists/{}/items/{}/purchase".format(test_wishlist.id, product_id)
+        resp = self.app.put(url, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["id"], product_id)
+        resp = self.app.put(url, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+    def test_purchase_product_not_found(self):
+        """ Purchase a product that is not in the wishlist """
+        wishlists = self._create_wishlists(2)
+        resp = self.app.post(
+            "/wishlists/{}/items".format(wishlists[0].id),
+            json={"item_id": 1, "name": "lamp"},
+            content_type="application/json"
+        )
+        product_id = resp.get_json()["id"]
+        resp = self.app.put(
+            "/wishlists/{}/items/{}/purchase".format(wishlists[1].id, product_id),
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.put(
+            "/wishlists/{}/items/0/purchase".format(wishlists[0].id),
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+# PURCHASE ITEMS FROM WISHLIST IN A BATCH
+    def test_purchase_product_batch(self):
+        """ Purchase many products at once """
+        test_wishlist = self._create_wishlists(1)[0]
+        resp = self.app.post(
+            "/wishlists/{}/items/batch".format(test_wishlist.id),
+            json=[{"item_id": item_id, "name": "item"} for item_id in range(3)],
+            content_type="application/json"
+        )
+        ids = [product["id"] for product in resp.get_json()]
+        resp = self.app.put(
+            "/wishlists/{}/items/{}/purchase".format(test_wishlist.id, ids[0]),
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put(
+            "/wishlists/{}/items/purchase".format(test_wishlist.id),
+            json={"ids": ids + [0]},
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(sorted(product["id"] for product in data["purchased"]), ids[1:])
+        self.assertTrue(all(product["purchased"] for product in data["purchased"]))
+        self.assertEqual(data["conflicts"], ids[:1])
+        self.assertEqual(data["not_found"], [0])
+
+    def test_purchase_product_batch_bad_data(self):
+        """ Purchase a batch without ids """
+        test_wishlist = self._create_wishlists(1)[0]
+        resp = self.app.put(
+            "/wishlists/{}/items/purchase".format(test_wishlist.id),
+            json={},
+            content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
 # GET ITEM LIST FROM WISHLIST
     def test_get_product_list(self):
         """ Get a list of Products """
@@ -424,3 +900,214 @@ class TestWishlistsServer(unittest.TestCase):
         self.assertEqual(len(data), 2)
         
 
+
+# CONDITIONAL REQUESTS
+    def test_get_wishlist_not_modified(self):
+        """ Get a Wishlist again with the ETag of the copy we have """
+        test_wishlist = self._create_wishlists(1)[0]
+        url = "/wishlists/{}".format(test_wishlist.id)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers["ETag"]
+        self.assertFalse(etag.startswith("W/"))
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.data, b"")
+        # adding an item changes the ETag
+        self._create_products(test_wishlist.id, 1)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(len(resp.get_json()["products"]), 1)
+
+    def test_get_wishlist_not_modified_skips_products(self):
+        """ A 304 for a Wishlist that is not cached only reads its version """
+        test_wishlist = self._create_wishlists(1)[0]
+        self._create_products(test_wishlist.id, 2)
+        url = "/wishlists/{}".format(test_wishlist.id)
+        etag = self.app.get(url).headers["ETag"]
+        cache.clear()
+        with self._count_queries() as statements:
+            resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("product", statements[0])
+
+    def test_get_product_list_not_modified(self):
+        """ Get the items of a Wishlist again with their ETag """
+        test_wishlist = self._create_wishlists(1)[0]
+        self._create_products(test_wishlist.id, 2)
+        url = "/wishlists/{}/items".format(test_wishlist.id)
+        etag = self.app.get(url).headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get("/wishlists/0/items", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_wishlists_list_not_modified(self):
+        """ Get a page of Wishlists again with its ETag """
+        wishlists = self._create_wishlists(3)
+        resp = self.app.get(BASE_URL)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # a change to any Wishlist on the page changes the ETag
+        self._create_products(wishlists[1].id, 1)
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_update_wishlist_if_match(self):
+        """ Update a Wishlist only if it has not changed since it was read """
+        test_wishlist = self._create_wishlists(1)[0]
+        url = "/wishlists/{}".format(test_wishlist.id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        data = resp.get_json()
+        data["name"] = "new name"
+        # somebody else adds an item first
+        self._create_products(test_wishlist.id, 1)
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        # read it again and retry
+        etag = self.app.get(url).headers["ETag"]
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["name"], "new name")
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(self.app.get(url).headers["ETag"], resp.headers["ETag"])
+
+# SPARSE FIELDS AND EMBEDDING
+    def test_get_wishlist_without_products(self):
+        """ Get a Wishlist without reading its Products """
+        test_wishlist = self._create_wishlists(1)[0]
+        self._create_products(test_wishlist.id, 2)
+        url = "/wishlists/{}".format(test_wishlist.id)
+        for query_string in ("embed=none", "fields=id,name"):
+            with self._count_queries() as statements:
+                resp = self.app.get(url, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(statements), 1)
+            self.assertNotIn("product", statements[0])
+        self.assertEqual(resp.get_json(), {"id": test_wishlist.id, "name": test_wishlist.name})
+
+    def test_get_wishlist_counts(self):
+        """ Get a Wishlist with the totals of its Products """
+        test_wishlist = self._create_wishlists(1)[0]
+        self._create_products(test_wishlist.id, 3)
+        item_id = self.app.get("/wishlists/{}/items".format(test_wishlist.id)).get_json()[0]["id"]
+        self.app.put("/wishlists/{}/items/{}/purchase".format(test_wishlist.id, item_id))
+        url = "/wishlists/{}".format(test_wishlist.id)
+        resp = self.app.get(url, query_string="embed=counts")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertNotIn("products", data)
+        self.assertEqual(data["counts"], {"items": 3, "purchased": 1})
+        # a cached Wishlist still has its totals counted by the database
+        self.app.get(url)
+        for query_string in ("embed=counts&fields=id,counts", "fields=id,counts"):
+            with self._count_queries() as statements:
+                resp = self.app.get(url, query_string=query_string)
+            self.assertEqual(resp.get_json(), {"id": test_wishlist.id, "counts": {"items": 3, "purchased": 1}})
+            self.assertEqual(len(statements), 2)
+            self.assertIn("GROUP BY", statements[1])
+
+    def test_get_wishlist_bad_fields(self):
+        """ Ask for fields or embeds that do not exist """
+        test_wishlist = self._create_wishlists(1)[0]
+        url = "/wishlists/{}".format(test_wishlist.id)
+        resp = self.app.get(url, query_string="fields=id,secret")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(url, query_string="embed=everything")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # what fields asks for can not be left out by embed
+        for query_string in ("fields=id,counts&embed=none", "fields=id,name&embed=counts",
+                             "fields=products,counts"):
+            resp = self.app.get(url, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+
+    def test_get_wishlists_list_counts(self):
+        """ List Wishlists with the totals of their Products """
+        wishlists = self._create_wishlists(3)
+        self._create_products(wishlists[0].id, 2)
+        resp = self.app.get(BASE_URL, query_string="embed=counts&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([wishlist["counts"]["items"] for wishlist in data], [2, 0])
+        self.assertTrue(all("products" not in wishlist for wishlist in data))
+        # the next page is asked for in the same way
+        next_url = re.match(r'<([^>]+)>; rel="next"', resp.headers["Link"]).group(1)
+        self.assertIn("embed=counts", next_url)
+        data = self.app.get(next_url).get_json()
+        self.assertEqual(data, [{"id": wishlists[2].id, "name": wishlists[2].name,
+                                 "customer_id": wishlists[2].customer_id,
+                                 "counts": {"items": 0, "purchased": 0}}])
+
+# MULTI-GET
+    def test_get_wishlists_by_ids(self):
+        """ Get many Wishlists by id with one query for them and one for their Products """
+        wishlists = self._create_wishlists(3)
+        for wishlist in wishlists:
+            self._create_products(wishlist.id, 2)
+        ids = [wishlists[2].id, 0, wishlists[0].id, wishlists[2].id]
+        with self._count_queries() as statements:
+            resp = self.app.get(BASE_URL, query_string="ids=" + ",".join(str(i) for i in ids))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(statements), 2)
+        data = resp.get_json()
+        self.assertEqual([wishlist["id"] for wishlist in data], [wishlists[2].id, 0, wishlists[0].id])
+        self.assertEqual(data[1], {"id": 0, "missing": True})
+        self.assertEqual(len(data[0]["products"]), 2)
+        self.assertEqual(data[2]["name"], wishlists[0].name)
+        # they are cached now, only their versions are read
+        with self._count_queries() as statements:
+            resp = self.app.get(BASE_URL, query_string="ids={},{}".format(wishlists[0].id, wishlists[2].id))
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("product", statements[0])
+        # their counts come from one GROUP BY query
+        with self._count_queries() as statements:
+            resp = self.app.get(BASE_URL, query_string="ids={},{}&embed=counts".format(wishlists[0].id, wishlists[2].id))
+        self.assertEqual(len(statements), 2)
+        self.assertIn("GROUP BY", statements[1])
+        self.assertEqual([wishlist["counts"]["items"] for wishlist in resp.get_json()], [2, 2])
+        etag = resp.headers["ETag"]
+        resp = self.app.get(BASE_URL, query_string="ids={},{}&embed=counts".format(wishlists[0].id, wishlists[2].id),
+                            headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_get_wishlists_by_bad_ids(self):
+        """ Ask for Wishlists with ids that are not valid """
+        for query_string in ("ids=1,a", "ids=", "ids=1&customer_id=2", "ids=1&limit=5"):
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+        max_page_size = app.config["MAX_PAGE_SIZE"]
+        app.config["MAX_PAGE_SIZE"] = 2
+        try:
+            resp = self.app.get(BASE_URL, query_string="ids=1,2,3")
+        finally:
+            app.config["MAX_PAGE_SIZE"] = max_page_size
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+# CONNECTION POOL
+    def test_pool_stats(self):
+        """ Get the state of the connection pool """
+        self._create_wishlists(1)
+        resp = self.app.get("/stats/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["pool"], type(db.engine.pool).__name__)
+        for name in ("checkouts", "timeouts", "wait_seconds_max", "connections_created", "connections_recycled"):
+            self.assertIn(name, data)
+
+    def test_pool_timeout(self):
+        """ A request that can not get a connection fails fast with 503 """
+        test_wishlist = self._create_wishlists(1)[0]
+        with patch.object(Wishlist, "exists", side_effect=PoolTimeoutError("QueuePool limit reached")):
+            resp = self.app.post(
+                "/wishlists/{}/items".format(test_wishlist.id),
+                json={"item_id": 1, "name": "lamp"},
+                content_type=CONTENT_TYPE_JSON
+            )
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.headers["Retry-After"], str(app.config["DB_POOL_RETRY_AFTER"]))
@@ -0,0 +1,48 @@
+"""
+Test cases for the JSON serializers
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+While debugging just these tests it's convinient to use this:
+    nosetests --stop tests/test_serializers.py:TestSerializers
+"""
+
+import json
+import unittest
+from unittest.mock import patch
+from service import app, serializers
+
+DATA = [{"id": 1, "name": "list", "customer_id": 2, "products": [
+    {"id": 3, "wishlist_id": 1, "item_id": 4, "name": "lamp é", "purchased": False}
+]}]
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+
+
+class TestSerializers(unittest.TestCase):
+    """ Test Cases for the JSON serializers """
+
+    def test_dumps(self):
+        """ Encode data as JSON bytes """
+        data = serializers.dumps(DATA)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data), DATA)
+
+    def test_dumps_without_orjson(self):
+        """ Fall back to the json module when orjson is not installed """
+        with patch.object(serializers, "orjson", None):
+            self.assertEqual(serializers.encoder_name(), "json")
+            data = serializers.dumps(DATA)
+        self.assertEqual(data, json.dumps(DATA, separators=(",", ":")).encode("utf-8"))
+
+    def test_json_response(self):
+        """ Build a JSON response with headers """
+        with app.test_request_context():
+            resp = serializers.json_response(DATA, 201, {"ETag": '"1"'})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertEqual(resp.headers["ETag"], '"1"')
+        self.assertEqual(resp.get_json(), DATA)